@@ -6,6 +6,23 @@ log.setLevel(getattr(logging, os.getenv("LOG_LEVEL") or "INFO"))
 URL = os.getenv("DIRECTUS_URL") or "http://localhost:8055"
 EMAIL = os.getenv("DIRECTUS_EMAIL") or "admin@example.com"
 PASSWORD = os.getenv("DIRECTUS_PASSWORD") or "password"
+TOKEN = os.getenv("DIRECTUS_TOKEN")  # a static token, used instead of logging in
+
+TIMEOUT = float(os.getenv("DIRECTUS_TIMEOUT") or 60)
+POOL_SIZE = int(os.getenv("DIRECTUS_POOL_SIZE") or 10)
+RETRIES = int(os.getenv("DIRECTUS_RETRIES") or 3)
+WORKERS = int(os.getenv("DIRECTUS_WORKERS") or 8)
+BATCH_SIZE = int(os.getenv("DIRECTUS_BATCH_SIZE") or 100)
+PAGE_SIZE = int(os.getenv("DIRECTUS_PAGE_SIZE") or 500)
+CONCURRENCY = int(os.getenv("DIRECTUS_CONCURRENCY") or 1)
+TRANSPORT = os.getenv("DIRECTUS_TRANSPORT") or "rest"
+CACHE_DIR = os.getenv("DIRECTUS_CACHE_DIR")  # unset disables the on-disk response cache
+CACHE_SIZE = int(os.getenv("DIRECTUS_CACHE_SIZE") or 64 * 2**20)
+STATE_DIR = os.getenv("DIRECTUS_STATE_DIR")  # unset disables state kept between runs
+TOKEN_DIR = os.getenv("DIRECTUS_TOKEN_DIR") or STATE_DIR  # unset disables the token cache
+INCREMENTAL = (os.getenv("DIRECTUS_INCREMENTAL") or '').lower() in ('1', 'true', 'yes')
+RECONCILE_INTERVAL = float(os.getenv("DIRECTUS_RECONCILE_INTERVAL") or 3600)
+SERVE_PORT = int(os.getenv("DIRECTUS_SERVE_PORT") or 8056)
 
 EXPORT_DIR = os.getenv("DIRECTUS_OUT_DIR")
 REPO = os.getenv("GITSYNC_REPO")
@@ -19,7 +36,7 @@ EXPORT_DIR = EXPORT_DIR or 'directus'
 
 from . import util
 from .api import API
-from .commands import diff, apply, export, wipe, data, seed
+from .commands import diff, apply, serve, export, wipe, data, seed, diff_schema_dirs
 # from .export import export
 # from .apply import apply, diff
 # from .wipe import wipe
@@ -1,7 +1,21 @@
-import requests
+import copy
+import json
+import hashlib
+import time
+import random
 import logging
-from . import URL, EMAIL, PASSWORD
-from .util import dict_diff, status_text, pretty_print_schema_diff, get_key, unpack_schema, pack_schema
+import threading
+import contextlib
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from . import URL, EMAIL, PASSWORD, TOKEN, TOKEN_DIR, TIMEOUT, POOL_SIZE, RETRIES, BATCH_SIZE, CONCURRENCY, PAGE_SIZE, WORKERS, TRANSPORT, CACHE_DIR, CACHE_SIZE, STATE_DIR
+from .cache import ResponseCache
+from .state import State
+from .tokens import TokenCache
+from .schema_diff import split_schema_diff, filter_schema, filter_schema_diff
+from .util import dict_diff, status_text, pretty_print_schema_diff, get_key, unpack_schema, pack_schema, item_digest
 from .topo_sort import create_graph_from_items, min_topological_sort
 log = logging.getLogger(__name__.split('.')[0])
 # log.setLevel(logging.DEBUG)
@@ -11,46 +25,506 @@ def localhost_subdomain_hotfix(url):  # FIXME: port
     p = urlparse(url)
     return (p._replace(netloc=f'localhost:{p.port}').geturl(), {'Host': p.hostname}) if p.hostname.endswith('localhost') else (url, {})
 
+# SEARCH is Directus' read-with-a-body verb, so it is as safe to retry as GET.
+IDEMPOTENT_METHODS = frozenset({'HEAD', 'GET', 'PUT', 'DELETE', 'OPTIONS', 'TRACE', 'SEARCH'})
+RETRY_STATUS = frozenset({429, 500, 502, 503, 504})
+
+
+def create_session(pool_size=POOL_SIZE, retries=RETRIES, backoff=0.5):
+    """Create a keep-alive session with a bounded connection pool.
+
+    Idempotent requests are retried with jittered exponential backoff on
+    connection errors and transient status codes. ``pool_block`` makes worker
+    threads wait for a free connection instead of opening throwaway ones.
+    """
+    retry = Retry(
+        total=retries, connect=retries, read=retries, status=retries,
+        backoff_factor=backoff, backoff_jitter=backoff,
+        status_forcelist=RETRY_STATUS, allowed_methods=IDEMPOTENT_METHODS,
+        respect_retry_after_header=True, raise_on_status=False)
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size,
+        max_retries=retry, pool_block=True)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+# keys ``_protected_ids`` looks at, never projected away
+PROTECTION_KEYS = frozenset({'admin_access', 'name', 'system', 'users', 'roles'})
+READ_METHODS = frozenset({'GET', 'HEAD', 'OPTIONS', 'SEARCH'})
+
+
+# POST endpoints that only compute or authenticate and never change state.
+# Only queries are ever sent to /graphql/system.
+READ_PATHS = ('/schema/diff', '/auth/', '/graphql/system')
+
+
+def _is_mutation(method, path):
+    return method.upper() not in READ_METHODS and not path.startswith(READ_PATHS)
+
+
+def _route_root(path):
+    """The collection-level route a path belongs to, e.g. /roles/abc -> /roles."""
+    return '/' + path.split('?', 1)[0].strip('/').split('/', 1)[0]
+
+
+def _graphql_value(value):
+    """Render a filter as a GraphQL input literal (object keys are unquoted)."""
+    if isinstance(value, dict):
+        return '{' + ', '.join(f'{key}: {_graphql_value(v)}' for key, v in value.items()) + '}'
+    if isinstance(value, (list, tuple, set)):
+        return '[' + ', '.join(_graphql_value(v) for v in value) + ']'
+    return json.dumps(value)
+
+
+def _flatten_relations(item, relational):
+    """Replace ``{pk: ...}`` subselections with the bare keys REST returns."""
+    if not isinstance(item, dict):
+        return item
+    item = dict(item)
+    for field, pk in relational.items():
+        value = item.get(field)
+        if isinstance(value, dict):
+            item[field] = value.get(pk)
+        elif isinstance(value, list):
+            item[field] = [v.get(pk) if isinstance(v, dict) else v for v in value]
+    return item
+
+
+class BatchError(requests.exceptions.HTTPError):
+    """Some items of a batched request failed. ``errors`` maps id -> error."""
+    def __init__(self, route, errors):
+        self.route, self.errors = route, errors
+        first = next(iter(errors.values()), None)
+        super().__init__(
+            f'{len(errors)} item(s) failed on {route}: '
+            + ', '.join(f'{k} ({_error_text(e)})' for k, e in errors.items()),
+            response=getattr(first, 'response', None))
+
+
+def _error_text(error):
+    response = getattr(error, 'response', None)
+    return f'{response.status_code}' if response is not None else str(error) or type(error).__name__
+
+
+def is_retryable(error):
+    """Whether a failed request may succeed when sent again unchanged."""
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    response = getattr(error, 'response', None)
+    return response is not None and (response.status_code == 429 or response.status_code >= 500)
+
+
 class API:
-    """An interface to the directus API."""
-    def __init__(self, url=URL, email=None, password=None):
+    """An interface to the directus API.
+    
+    A single pooled session is shared by every request, including requests
+    issued from worker threads. Per-call headers are merged into a fresh dict
+    so concurrent callers never mutate shared state.
+    """
+    # run-scoped response cache, see ``cached()``. These are class defaults so
+    # that lightweight subclasses (e.g. test doubles) work without __init__.
+    _cache = None
+    _cache_generation = None
+    _cache_lock = threading.Lock()
+    # one ``/fields`` read at a time, see ``fields()``
+    _fields_lock = threading.Lock()
+    # route -> ids mutated through this client, see ``_record_mutation``
+    touched = None
+    batch_size = BATCH_SIZE
+    page_size = PAGE_SIZE
+    read_workers = WORKERS
+    concurrency = CONCURRENCY
+    create_retries = RETRIES
+    retry_backoff = 1.0
+    # per-route caps on ``concurrency``. Extensions are installed by custom
+    # handlers that must run in order.
+    route_concurrency = {'/extensions': 1}
+    # how commands read managed state: 'rest' (a request per route) or
+    # 'graphql' (one /graphql/system query, see ``query_system``)
+    transport = TRANSPORT
+    # on-disk cache of GET responses that survives between runs, see ``cache.py``
+    response_cache = None
+    identity = None
+    # facts kept between runs, see ``state.py``
+    state = None
+    # from the last login, so that a long-running process can stay logged in
+    refresh_token = None
+    token_expires = None
+    _auth_lock = threading.RLock()
+    # a static token (e.g. of a service account) used instead of logging in
+    static_token = None
+    # where tokens are kept between runs, see ``tokens.py``
+    token_dir = None
+    token_cache = None
+    _credentials = None
+
+    def __init__(self, url=URL, email=None, password=None, timeout=TIMEOUT, pool_size=POOL_SIZE, retries=RETRIES, batch_size=BATCH_SIZE, concurrency=CONCURRENCY, route_concurrency=None, transport=TRANSPORT, cache_dir=CACHE_DIR, cache_size=CACHE_SIZE, state_dir=STATE_DIR, token=TOKEN, token_dir=TOKEN_DIR):
+        if transport not in ('rest', 'graphql'):
+            raise ValueError(f'transport must be rest or graphql; got {transport!r}')
         self.url, self.headers = url, {} #localhost_subdomain_hotfix(url)
+        self.transport = transport
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.route_concurrency = {**self.route_concurrency, **(route_concurrency or {})}
+        self.session = create_session(pool_size=max(pool_size, concurrency), retries=retries)
+        self.touched = {}
+        self.static_token = token
+        self.token_dir = token_dir
+        if cache_dir:
+            self.response_cache = ResponseCache(cache_dir, cache_size)
+        if state_dir:
+            self.state = State(state_dir, url)
         if email:
             password = password or input("Directus password pls: ")
             if password:
                 self.login(email, password)
 
     def login(self, email=EMAIL, password=PASSWORD):
-        """Login to directus to get an access token."""
-        # Authenticate and get access token
-        response = requests.post(f'{self.url}/auth/login', json={"email": email, "password": password}, headers=self.headers)
+        """Login to directus to get an access token.
+
+        A static token (``DIRECTUS_TOKEN``) is used as is. Otherwise tokens
+        cached by an earlier run (``DIRECTUS_TOKEN_DIR``, by default the state
+        directory) are reused, refreshed if they expired, and the password is
+        only sent when that fails.
+        """
+        if self.static_token:
+            self.headers['Authorization'] = f"Bearer {self.static_token}"
+            self.identity = 'token:' + hashlib.sha1(self.static_token.encode()).hexdigest()[:12]
+            return self
+        self.identity = email
+        self._credentials = (email, password)
+        if self.token_dir:
+            self.token_cache = TokenCache(self.token_dir, self.url, email)
+            cached = self.token_cache.load()
+            if cached and cached.get('access_token'):
+                self.access_token = cached['access_token']
+                self.refresh_token = cached.get('refresh_token')
+                self.token_expires = cached.get('expires_at')
+                self.headers['Authorization'] = f"Bearer {self.access_token}"
+                self._ensure_token()
+                log.debug('Reusing the cached access token')
+                return self
+        return self._login(email, password)
+
+    def _login(self, email, password):
+        response = self.session.post(f'{self.url}/auth/login', json={"email": email, "password": password}, headers=self.headers, timeout=self.timeout)
         response.raise_for_status()
-        self.access_token = response.json()["data"]["access_token"]
+        self._set_tokens(response.json()["data"])
+        return self
+
+    def _set_tokens(self, data):
+        self.access_token = data["access_token"]
+        self.refresh_token = data.get("refresh_token")
+        # ``expires`` is the lifetime of the access token in milliseconds
+        self.token_expires = time.time() + data["expires"] / 1000 if data.get("expires") else None
         self.headers['Authorization'] = f"Bearer {self.access_token}"
+        if self.token_cache is not None:
+            self.token_cache.store({
+                'access_token': self.access_token,
+                'refresh_token': self.refresh_token,
+                'expires_at': self.token_expires,
+            })
+
+    def refresh(self):
+        """Trade the refresh token for a new access token."""
+        response = self.session.post(
+            f'{self.url}/auth/refresh', json={"refresh_token": self.refresh_token, "mode": "json"},
+            headers={k: v for k, v in self.headers.items() if k != 'Authorization'}, timeout=self.timeout)
+        response.raise_for_status()
+        self._set_tokens(response.json()["data"])
         return self
 
+    def _reauthenticate(self, rejected=None):
+        """Replace the access token: refresh it, or log in again as a last resort.
+
+        ``rejected`` is the token a request failed with. If another thread
+        already replaced it, nothing is done, since a refresh token can be
+        used only once.
+        """
+        with self._auth_lock:
+            if rejected is not None and rejected != self.access_token:
+                return self
+            if self.refresh_token:
+                try:
+                    log.debug('Refreshing the access token')
+                    return self.refresh()
+                except requests.exceptions.RequestException as e:
+                    log.debug('Could not refresh the access token: %s', e)
+            if self._credentials is None:
+                raise ValueError('the access token expired and there are no credentials to log in again')
+            log.debug('Logging in again')
+            return self._login(*self._credentials)
+
+    def _ensure_token(self):
+        """Replace the access token shortly before it expires."""
+        # a small margin so that a token never expires during a request
+        if self.token_expires is None or time.time() < self.token_expires - 30:
+            return
+        if not self.refresh_token and self._credentials is None:
+            return
+        self._reauthenticate(self.access_token)
+
     def json(self, method, path, raw=False, **kw):
         log.debug(f'🐦 ↑{method} {path} %s', kw)
+        if not _is_mutation(method, path):
+            return self._json(method, path, raw, **kw)
+        self.invalidate(path)
+        try:
+            return self._json(method, path, raw, **kw)
+        finally:
+            # a read that ran while the change was in flight may have cached
+            # the old state under the new generation
+            self.invalidate(path)
+
+    def _json(self, method, path, raw=False, **kw):
+        self._ensure_token()
         headers = {**self.headers, **kw.pop('headers', {})}
-        r = requests.request(method, f"{self.url}{path}", headers=headers, **kw)
+        kw.setdefault('timeout', self.timeout)
+        cache_key = entry = None
+        if self.response_cache is not None and method.upper() == 'GET':
+            # keyed by who is asking, since responses depend on permissions
+            cache_key = self.response_cache.key(
+                self.identity or self.headers.get('Authorization'), self.url, path, kw.get('params'))
+            entry = self.response_cache.load(cache_key)
+            headers.update(self.response_cache.validators(entry))
+        r = self.session.request(method, f"{self.url}{path}", headers=headers, **kw)
+        if r.status_code == 401 and self._credentials is not None and not path.startswith('/auth/'):
+            # e.g. a cached token that was revoked before it expired
+            self._reauthenticate(headers['Authorization'].removeprefix('Bearer '))
+            headers['Authorization'] = self.headers['Authorization']
+            r = self.session.request(method, f"{self.url}{path}", headers=headers, **kw)
+        if cache_key is not None:
+            r = self.response_cache.resolve(cache_key, entry, r)
         log.debug(f'{"🟢" if r.ok else "🔴"} ↓{method} {path} {r.status_code} {r.content}')
         try:
             r.raise_for_status()
             if raw:
                 return r.content
-            elif r.content:
-                return r.json()
+            result = r.json() if r.content else None
         except requests.exceptions.HTTPError as e:
             log.error('%s: %s', r.status_code, r.content.decode())
             raise
         except requests.exceptions.JSONDecodeError as e:
             raise ValueError(f"Could not read: {r.content}")
+        if _is_mutation(method, path):
+            self._record_mutation(path, kw.get('json'), result)
+        return result
+
+    def _record_mutation(self, path, payload, result):
+        """Remember which route and ids a successful request changed."""
+        if self.touched is None:
+            return
+        ids = set()
+        key = path.split('?', 1)[0].strip('/').split('/')[1:2]
+        if key:
+            ids.add(key[0])
+        for value in (payload, (result or {}).get('data') if isinstance(result, dict) else None):
+            for item in value if isinstance(value, list) else [value]:
+                if isinstance(item, dict) and item.get('id') is not None:
+                    ids.add(str(item['id']))
+                elif isinstance(item, (str, int)) and isinstance(value, list):
+                    ids.add(str(item))
+        with self._cache_lock:
+            self.touched.setdefault(_route_root(path), set()).update(ids)
+
+    # ----------------------------------- Cache ---------------------------------- #
+
+    @contextlib.contextmanager
+    def cached(self):
+        """Share remote reads between every phase of a run.
+
+        Inside this context ``fetch`` serves repeated reads of the same route
+        and query from memory. Any mutating request drops the cached entries
+        for its route, so a route is re-read only after it was changed.
+        """
+        if self._cache is not None:  # already inside a run
+            yield self
+            return
+        self._cache, self._cache_generation = {}, 0
+        try:
+            yield self
+        finally:
+            self._cache = None
+
+    def invalidate(self, path=None):
+        """Drop cached reads for the route that ``path`` belongs to (or all)."""
+        root = _route_root(path) if path else None
+        if self._cache is None:
+            return
+        with self._cache_lock:
+            if root in (None, '/schema'):  # schema changes cascade to every route
+                self._cache.clear()
+            else:
+                # graphql queries span several routes, so any change drops them
+                for key in [key for key in self._cache if _route_root(key[0]) in (root, '/graphql')]:
+                    del self._cache[key]
+            self._cache_generation += 1
+
+    def fetch(self, route, paginate=False, **params):
+        """GET the ``data`` of a route, reusing this run's cached response."""
+        key = (route, paginate, json.dumps(params, sort_keys=True, default=str))
+        return self._cached(key, lambda: self._fetch(route, params, paginate))
+
+    def _cached(self, key, load):
+        if self._cache is None:
+            return load()
+        with self._cache_lock:
+            if key in self._cache:
+                return copy.copy(self._cache[key])
+            generation = self._cache_generation
+        data = load()
+        with self._cache_lock:
+            # don't keep a read that may have raced with a mutation
+            if self._cache is not None and self._cache_generation == generation:
+                self._cache[key] = data
+        return copy.copy(data)
+
+    def fetch_all(self, route, **params):
+        """GET every item of a collection route, see ``_fetch_pages``."""
+        return self.fetch(route, paginate=True, **params)
+
+    def projection(self, route, exclude=None, keep=PROTECTION_KEYS):
+        """A ``fields`` query for a system route that leaves ``exclude`` out.
+
+        ``keep`` keys are always read because deciding whether a role or
+        policy may be deleted depends on them.
+        """
+        exclude = _ignored_keys(exclude) - set(keep or ())
+        collection = 'directus_' + route.strip('/').split('/')[0]
+        try:
+            fields = [f['field'] for f in self.fields() if f.get('collection') == collection]
+        except requests.exceptions.RequestException:
+            return {}
+        selected = [f for f in fields if f not in exclude]
+        return {'fields': ','.join(selected)} if selected and len(selected) < len(fields) else {}
+
+    def fields(self):
+        """The field metadata of the system collections, from one ``/fields`` read.
+
+        Inside ``cached()`` the read is shared by all routes and threads.
+        """
+        # serialized, so that concurrent projections wait for the first read
+        # instead of issuing their own
+        with self._fields_lock:
+            fields = self.fetch('/fields', filter=json.dumps({'collection': {'_starts_with': 'directus_'}}))
+        # the client-side filter stays as a guard against servers ignoring it
+        return [
+            f for f in fields or []
+            if isinstance(f, dict) and str(f.get('collection')).startswith('directus_')
+        ]
+
+    def query_system(self, queries):
+        """Read several system collections with one ``/graphql/system`` query.
+
+        ``queries`` maps a collection name as used in routes (``roles``,
+        ``settings``, ...) to an optional ``exclude`` key list and ``filter``.
+        Field lists are derived from the field and relation metadata, since
+        GraphQL has no ``*``. Relational fields are read as their keys, so
+        items have the same shape as REST responses.
+        """
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            fields = pool.submit(self.fields)
+            relations = self.fetch('/relations')
+            fields = fields.result()
+        primary = {
+            f['collection']: f['field'] for f in fields
+            if (f.get('schema') or {}).get('is_primary_key')
+        }
+        related = {}
+        for r in relations:
+            if r.get('related_collection'):  # many-to-one
+                related[r['collection'], r['field']] = r['related_collection']
+            one_field = (r.get('meta') or {}).get('one_field')
+            if one_field:  # one-to-many
+                related[r['related_collection'], one_field] = r['collection']
+
+        parts, relational = [], {}
+        for name, options in queries.items():
+            collection = f'directus_{name}'
+            exclude = set(options.get('exclude') or ())
+            selection, relational[name] = [], {}
+            for f in fields:
+                if f['collection'] != collection or f['field'] in exclude:
+                    continue
+                if (collection, f['field']) in related:
+                    pk = primary.get(related[collection, f['field']], 'id')
+                    selection.append(f"{f['field']} {{ {pk} }}")
+                    relational[name][f['field']] = pk
+                elif f.get('type') != 'alias':  # other aliases only lay out the app
+                    selection.append(f['field'])
+            if name == 'settings':
+                parts.append(f"settings {{ {' '.join(selection)} }}")
+                continue
+            args = {'limit': -1}
+            if options.get('filter'):
+                args['filter'] = options['filter']
+            args = ', '.join(f'{key}: {_graphql_value(value)}' for key, value in args.items())
+            parts.append(f"{name}({args}) {{ {' '.join(selection)} }}")
+
+        query = '{ ' + ' '.join(parts) + ' }'
+        data = self._cached(('/graphql/system', False, query), lambda: self._graphql(query))
+        return {
+            name: ([_flatten_relations(item, relational[name]) for item in data[name]]
+                   if isinstance(data[name], list) else _flatten_relations(data[name], relational[name]))
+            for name in queries
+        }
+
+    def _graphql(self, query):
+        result = self.json('POST', '/graphql/system', json={'query': query})
+        if result.get('errors'):
+            raise ValueError('GraphQL query failed: ' + '; '.join(
+                str(error.get('message', error)) for error in result['errors']))
+        return result['data']
+
+    def _fetch(self, route, params, paginate=False):
+        if paginate:
+            return self._fetch_pages(route, params)
+        return (self.json('GET', route, params=params) if params else self.json('GET', route))['data']
+
+    def _fetch_pages(self, route, params):
+        """Read a route page by page instead of trusting the server's default limit.
+
+        The first page asks for the matching row count; the remaining pages
+        are then fetched concurrently, sized like the first one since the
+        server may clamp ``limit`` (``QUERY_LIMIT_MAX``). When the server
+        reports no count, pages are read in order until a short one comes back.
+        Pages are sorted by id, so that offsets neither skip nor repeat rows.
+        """
+        size = self.page_size
+        params = {'sort': 'id', **params}
+        first = self.json('GET', route, params={**params, 'limit': size, 'offset': 0, 'meta': 'filter_count'})
+        items = first['data']
+        total = (first.get('meta') or {}).get('filter_count')
+        if not isinstance(items, list) or not items:
+            return items
+        if total is not None:
+            step = len(items)
+            offsets = range(step, int(total), step)
+            with ThreadPoolExecutor(max_workers=max(1, min(self.read_workers, len(offsets) or 1))) as pool:
+                pages = pool.map(
+                    lambda offset: self.json('GET', route, params={**params, 'limit': step, 'offset': offset})['data'],
+                    offsets)
+                return items + [item for page in pages for item in page]
+        if len(items) < size:
+            return items
+        offset, page = size, items
+        while len(page) >= size:
+            previous, page = page, self.json('GET', route, params={**params, 'limit': size, 'offset': offset})['data']
+            if page == previous:  # the server ignores offset
+                break
+            items.extend(page)
+            offset += size
+        return items
 
     # --------------------------------- Settings --------------------------------- #
 
     def export_settings(self):
         """Get settings."""
-        return self.json('GET', '/settings')['data']
+        return self.fetch('/settings')
     
     def apply_settings(self, settings, **kw):
         """Update server settings."""
@@ -74,25 +548,48 @@ class API:
         schema = unpack_schema(self.export_schema())
         return schema
 
-    def diff_schema(self, schema, force=False):
+    def diff_schema(self, schema, force=False, collections=None):
         # https://docs.directus.io/reference/system/schema.html#retrieve-schema-difference
         schema = sanitize_schema_null_collections(schema)
+        if collections:
+            # only send the collections in scope, and ignore the rest of the
+            # server's schema, which then looks like it should be deleted
+            schema = filter_schema(schema, collections)
+        marker = None
+        if self.state is not None:
+            # The last local and remote schema that Directus found nothing to
+            # change between. The snapshot is read before the diff so that a
+            # concurrent change can only cause an extra diff, never a skipped one.
+            marker = {
+                'local': item_digest(schema), 'force': bool(force),
+                'remote': item_digest(self.fetch('/schema/snapshot')),
+            }
+            if self.state.get('schema') == marker:
+                log.debug('Schema unchanged since the last diff, skipping /schema/diff')
+                return None
         diff = self.json('POST', '/schema/diff', params={"force": force}, json=schema)
-        return sanitize_diff_null_collections(diff['data']) if diff else None
+        diff = sanitize_diff_null_collections(diff['data']) if diff else None
+        if collections:
+            diff = filter_schema_diff(diff, collections)
+        if marker is not None:
+            self.state.update(schema=None if diff else marker)
+        return diff
     
-    def diff_unpacked_schema(self, schema, force=False):
+    def diff_unpacked_schema(self, schema, force=False, collections=None):
         schema = pack_schema(schema)
-        return self.diff_schema(schema, force=force)
+        return self.diff_schema(schema, force=force, collections=collections)
     
     def apply_schema(self, schema_diff):
         # https://docs.directus.io/reference/system/schema.html#apply-schema-difference
         result = self.json('POST', '/schema/apply', json=schema_diff)
+        if self.state is not None:
+            self.state.update(schema=None)
         log.info("Schema :: \033[93mdiff applied.\033[0m")
         return result
     
-    def diff_apply_schema(self, schema, force=False, yes=False):
+    def diff_apply_schema(self, schema, force=False, yes=False, chunk_size=0, collections=None):
         if schema:
-            diff = self.diff_schema(schema, force=force)
+            diff = self.diff_schema(schema, force=force, collections=collections)
             # print(diff)
             has_changes = pretty_print_schema_diff(diff or {}, confirm_delete=not yes)
             if not has_changes:
@@ -100,21 +597,54 @@ class API:
                 return
             
             try:
+                if chunk_size:
+                    return self.apply_schema_in_chunks(
+                        schema, force=force, chunk_size=chunk_size, diff=diff, collections=collections)
                 return self.apply_schema(diff)
             except requests.exceptions.HTTPError as e:
                 log.error("Schema      :: \033[91merror applying diff.\033[0m")
                 log.error(e.response.content)
                 raise
 
-    def diff_apply_unpacked_schema(self, schema, force=False, yes=False):
+    def diff_apply_unpacked_schema(self, schema, force=False, yes=False, chunk_size=0, collections=None):
         schema = pack_schema(schema)
-        return self.diff_apply_schema(schema, force=force, yes=yes)
+        return self.diff_apply_schema(schema, force=force, yes=yes, chunk_size=chunk_size, collections=collections)
+
+    def apply_schema_in_chunks(self, schema, force=False, chunk_size=20, diff=None, collections=None):
+        """Apply the diff towards ``schema`` a few collections or relations at a time.
+
+        Each round re-diffs against the server, which also gives the snapshot
+        hash for the next chunk, and applies the first chunk of
+        ``split_schema_diff``. Applied chunks drop out of the next diff, so an
+        interrupted run resumes where it stopped; the count of completed
+        chunks is kept in the state for progress reporting.
+        """
+        marker, done, previous = item_digest(schema), 0, None
+        if self.state is not None:
+            progress = self.state.get('schema_chunks') or {}
+            if progress.get('schema') == marker:
+                done = progress['done']
+                log.info(f"Schema      :: resuming after {done} applied chunk(s).")
+        while True:
+            diff = diff or self.diff_schema(schema, force=force, collections=collections)
+            chunks = split_schema_diff(diff['diff'], chunk_size) if diff else []
+            if not chunks:
+                break
+            if chunks[0] == previous:
+                raise RuntimeError('schema chunk did not apply; Directus still reports: ' + json.dumps(previous))
+            self.apply_schema({'hash': diff['hash'], 'diff': chunks[0]})
+            done, previous, diff = done + 1, chunks[0], None
+            if self.state is not None:
+                self.state.update(schema_chunks={'schema': marker, 'done': done})
+            log.info(f"Schema      :: chunk {done}/{done + len(chunks) - 1} applied.")
+        if self.state is not None:
+            self.state.update(schema_chunks=None)
     
     # ---------------------------------- Presets --------------------------------- #
 
-    def export_presets(self):
+    def export_presets(self, **params):
         """Get all presets"""
-        return self.json('GET', '/presets')['data']
+        return self.fetch_all('/presets', **params)
     
     def apply_presets(self, items, **kw):
         """Update server with presets configurations."""
@@ -122,9 +652,9 @@ class API:
 
     # --------------------------------- Policies -------------------------------- #
 
-    def export_policies(self):
+    def export_policies(self, **params):
         """Get access policies."""
-        return self.json('GET', '/policies')['data']
+        return self.fetch_all('/policies', **params)
 
     def apply_policies(self, items, **kw):
         """Update access policies without carrying environment user bindings."""
@@ -136,7 +666,7 @@ class API:
 
     def export_folders(self):
         """Get all folders"""
-        return self.json('GET', '/folders')['data']
+        return self.fetch_all('/folders')
 
     def apply_folders(self, items, **kw):
         """Update server with folders configurations."""
@@ -146,11 +676,11 @@ class API:
     
     def export_operations(self):
         """Get all operations"""
-        return self.json('GET', '/operations')['data']
+        return self.fetch_all('/operations')
     
     def export_flows(self):
         """Get all flows"""
-        return self.json('GET', '/flows')['data']
+        return self.fetch_all('/flows')
     
     def apply_operations(self, items, **kw):
         """Update server with operations configurations."""
@@ -165,7 +695,7 @@ class API:
     
     def export_webhooks(self):
         """Get all webhooks"""
-        return self.json('GET', '/webhooks')['data']
+        return self.fetch_all('/webhooks')
     
     def apply_webhooks(self, items, **kw):
         """Update server with webhooks configurations."""
@@ -175,11 +705,11 @@ class API:
     
     def export_panels(self):
         """Get all panels"""
-        return self.json('GET', '/panels')['data']
+        return self.fetch_all('/panels')
     
     def export_dashboards(self):
         """Get all dashboards"""
-        return self.json('GET', '/dashboards')['data']
+        return self.fetch_all('/dashboards')
     
     def apply_panels(self, items, **kw):
         """Update server with panels configurations."""
@@ -191,17 +721,17 @@ class API:
 
     # ----------------------------------- Roles ---------------------------------- #
     
-    def export_roles(self):
+    def export_roles(self, **params):
         """Get all roles"""
-        return self.json('GET', '/roles')['data']
+        return self.fetch_all('/roles', **params)
 
-    def export_permissions(self):
+    def export_permissions(self, **params):
         """Get all permissions"""
-        return self.json('GET', '/permissions')['data']
+        return self.fetch_all('/permissions', **params)
     
     def export_users(self):
         """Get all users"""
-        return self.json('GET', '/users')['data']
+        return self.fetch_all('/users')
     
     def apply_roles(self, items, **kw):
         """Update server with roles configurations."""
@@ -225,7 +755,7 @@ class API:
 
     def export_extensions(self):
         """Get all extensions"""
-        data = self.json('GET', '/extensions')['data']
+        data = self.fetch('/extensions')
 
         bundles = {}
         for d in data:
@@ -255,9 +785,7 @@ class API:
         def NEW(k, d):
             bundle_extensions = d.pop('bundle_extensions', [])
 
-            registry = self.json('GET', f'/extensions/registry/extension/{d["id"]}')['data']
-            version_id = next((v['id'] for v in registry['versions'] if v['version'] == d.get('schema') and d['schema']['version']), None)
-            # version_id = next((v['id'] for v in registry['versions'] if v['version'] == d['id']), None)
+            version_id = version_ids.get((d.get('id'), (d.get('schema') or {}).get('version')))
             if version_id:
                 log.info(f"🌱 Installing extension {d['schema']['name']} {d['schema']['version']}")
                 self.json('POST', '/extensions/registry/install', json={
@@ -295,6 +823,9 @@ class API:
                 # self.json('DELETE', f'/extensions/{d["id"]}')
 
         existing = self.export_extensions()
+        # only installs need the registry; they run in order, the lookups don't
+        installed = {d.get('id') for d in existing}
+        version_ids = self.registry_version_ids([d for d in items if d.get('id') not in installed])
         # for d in sorted(existing, key=lambda d: d['schema']['name']):
         #     print(d['schema']['name'])
         # print("----")
@@ -319,6 +850,29 @@ class API:
             DELETE=DELETE,
             **kw)
 
+    def registry_version_ids(self, items):
+        """Resolve the registry version id of each extension's schema version.
+
+        Lookups run concurrently. The id of a published version never
+        changes, so resolved ids are remembered in the state between runs.
+        Returns ``{(extension id, version): version id or None}``.
+        """
+        wanted = {(d['id'], (d.get('schema') or {}).get('version')) for d in items if d.get('id')}
+        known = dict(self.state.get('registry_versions') or {}) if self.state is not None else {}
+        missing = [key for key in wanted if '@'.join(map(str, key)) not in known]
+
+        def resolve(key):
+            registry = self.fetch(f'/extensions/registry/extension/{key[0]}')
+            return next((v['id'] for v in registry.get('versions', []) if v.get('version') == key[1]), None)
+
+        with ThreadPoolExecutor(max_workers=max(1, min(self.read_workers, len(missing)))) as pool:
+            for key, version_id in zip(missing, pool.map(resolve, missing)):
+                if version_id:
+                    known['@'.join(map(str, key))] = version_id
+        if self.state is not None and missing:
+            self.state.update(registry_versions=known)
+        return {key: known.get('@'.join(map(str, key))) for key in wanted}
+
     # ----------------------------------- Misc ----------------------------------- #
 
     def export_graphql_sdl(self):
@@ -330,114 +884,100 @@ class API:
 
     def _apply(self, route, items, existing=None, forbidden_keys=None, allow_delete=True, desc_keys=None, NEW='POST', UPDATE='PATCH', DELETE='DELETE'):
         if existing is None:
-            existing = self.json('GET', route)['data']
-        existing = {d['id']: dict(d) for d in existing if 'id' in d}
-        protected_role_ids = {
-            item['id']
-            for item in existing.values()
-            if '/roles' in route
-            and (
-                item.get('admin_access') is not False
-                or item.get('system')
-                or item.get('users')
-            )
-        }
-        protected_policy_ids = {
-            item['id']
-            for item in existing.values()
-            if '/policies' in route
-            and (
-                item.get('admin_access') is not False
-                or item.get('name') == '$t:public_label'
-                or item.get('system')
-                or item.get('roles')
-                or item.get('users')
-            )
-        }
-        items = {d['id']: dict(d) for d in items}
+            existing = self.fetch_all(route, **self.projection(route, forbidden_keys))
+        existing = [d for d in existing if 'id' in d]
+        protected = _protected_ids(route, {d['id']: d for d in existing})
+        ignore = _ignored_keys(forbidden_keys)
+        items = {d['id']: _without(d, ignore) for d in items}
+        existing = {d['id']: _without(d, ignore) for d in existing}
         log.debug(f'items {route} {set(items)}')
         log.debug(f'existing {route} {set(existing)}')
 
-        for d in [items, existing]:
-            for k in d:
-                for ki in ['user_created', 'user_updated']:  # XXX: is this desired? it's needed when copying between instances but we're losing this information
-                    d[k].pop(ki, None)
-                for ki in (forbidden_keys or []):
-                        d[k].pop(ki, None)
-
         # check for new
         new = set(items) - set(existing)
         log.debug(f'new {route} {new}')
+
+        # check for changes. Matching digests settle most items; only the
+        # few that differ get a key-by-key comparison.
+        in_common = set(items) & set(existing)
+        diffs = {
+            k: dict_diff(existing[k], items[k]) for k in in_common
+            if item_digest(existing[k]) != item_digest(items[k])
+        }
+        update = {k for k, diff in diffs.items() if any(diff)}
+        unchanged = in_common - update
+        log.debug(f'diffs {route} {diffs}')
+        log.debug(f'update {route} {update}')
+
+        # check for deletions
+        missing = set(existing) - set(items)
+        delete = [k for k in missing if k not in protected] if allow_delete else []
+        log.debug(f'missing {route} {missing}')
+        log.debug(f'delete {route} {delete}')
+        if missing and not allow_delete:
+            log.warning(f"Missing (skipping delete) {route}: {missing}")
+
+        return self._execute(
+            route, items, existing, new, update, delete, unchanged,
+            diffs=diffs, desc_keys=desc_keys, NEW=NEW, UPDATE=UPDATE, DELETE=DELETE)
+
+    def apply_planned(self, route, payloads, existing=None, forbidden_keys=None, desc_keys=None, NEW='POST', UPDATE='PATCH', DELETE='DELETE'):
+        """Run exactly the ``create``/``update``/``delete`` payloads of a saved plan.
+
+        Items are not re-diffed against the server, but protected roles and
+        policies are still never deleted. Protection is decided on the
+        current ``existing`` items where given, since the plan's copies may
+        predate e.g. a user being assigned to a role.
+        """
+        ignore = _ignored_keys(forbidden_keys)
+        create = {d['id']: _without(d, ignore) for d in payloads.get('create', [])}
+        update = {d['id']: _without(d, ignore) for d in payloads.get('update', [])}
+        current = {d['id']: d for d in existing or () if 'id' in d}
+        existing = {d['id']: current.get(d['id'], d) for d in payloads.get('delete', [])}
+        protected = _protected_ids(route, existing)
+        existing = {k: _without(d, ignore) for k, d in existing.items()}
+        items = {**create, **update}
+        delete = [k for k in existing if k not in protected]
+        return self._execute(
+            route, items, existing, set(create), set(update), delete,
+            desc_keys=desc_keys, NEW=NEW, UPDATE=UPDATE, DELETE=DELETE)
+
+    def _execute(self, route, items, existing, new, update, delete, unchanged=(), diffs=None, desc_keys=None, NEW='POST', UPDATE='PATCH', DELETE='DELETE'):
         if new:
             new_b4 = new
             new_graph = create_graph_from_items({k: items[k] for k in new}, "id")
-            new = min_topological_sort(new_graph, flat=True)
+            layers = [sorted(layer, key=str) for layer in min_topological_sort(new_graph, flat=False)]
+            new = [k for layer in layers for k in layer]
             assert set(new)==set(new_b4)
 
             if NEW:
-                new_fn = (lambda k, d: self.json(NEW, route, json=d)) if not callable(NEW) else NEW
-
                 log.info(f"🌱 Creating {route}: {new}")
-                # self.json('POST', route, json=[items[k] for k in new])
-                failed = []
-                for k in new:
-                    try:
-                        new_fn(k, items[k])
-                    except requests.exceptions.HTTPError:
-                        failed.append(k)
-                for k in failed:
-                    new_fn(k, items[k])
+                self._create_layers(route, items, new_graph, layers, NEW)
             else:
                 log.info(f"🌱 Unable to automatically create {route}")
                 for k in new:
                     log.info(f"🌱 ATTENTION: Would create {route}: {k}\n{items[k]}")
 
-        # check for changes
-        in_common = set(items) & set(existing)
-        diffs = {k: dict_diff(existing[k], items[k]) for k in in_common}
-        update = {k for k in in_common if any(diffs[k])}
-        unchanged = in_common - update
-        log.debug(f'diffs {route} {diffs}')
-        log.debug(f'update {route} {update}')
-
         if update:
             if UPDATE:
-                update_fn = (lambda k, d, old=None: self.json(UPDATE, f'{route}/{k}', json=d)) if not callable(UPDATE) else UPDATE
                 log.info(f"🔧 Updating {route}: {update}")
-                for k in update:
-                    update_fn(k, items[k], existing[k])
-                    # self.json(UPDATE, f'{route}/{k}', json=items[k])
+                if callable(UPDATE):
+                    self._map(route, lambda k: UPDATE(k, items[k], existing.get(k)), sorted(update, key=str))
+                else:
+                    # changed items go out as bulk PATCHes; failures are
+                    # collected per item and reported once every batch ran
+                    errors = self._send_batches(UPDATE, route, [items[k] for k in sorted(update, key=str)])
+                    if errors:
+                        raise BatchError(route, errors)
             else:
                 log.info(f"🔧 Unable to automatically update {route}")
                 for k in update:
-                    log.info(f"🔧 ATTENTION: Would update {route}: {k}\n{diffs[k]}")
-        
-        # check for deletions
-        missing = set(existing) - set(items)
-        delete = missing if allow_delete else set()
-        log.debug(f'missing {route} {missing}')
-        log.debug(f'delete {route} {delete}')
-        if '/roles' in route:  # FIXME: this is janky
-            # Directus 11 reports the built-in Administrator role with
-            # ``admin_access: null``. Never remove protected roles, roles
-            # still assigned to users, or system roles during reconciliation.
-            delete = [
-                k for k in delete
-                if k not in protected_role_ids
-                and existing[k].get('admin_access') is False
-            ]
-        if '/policies' in route:
-            delete = [
-                k for k in delete
-                if k not in protected_policy_ids
-                and existing[k].get('admin_access') is False
-            ]
+                    log.info(f"🔧 ATTENTION: Would update {route}: {k}\n{(diffs or {}).get(k)}")
+
         if delete and DELETE:
             delete_fn = (lambda ks, ds: self.json(DELETE, route, json=list(ks))) if not callable(DELETE) else DELETE
             log.warning(f"🗑 Deleting {route}: {delete}")
             delete_fn(delete, existing)
-        elif missing and not allow_delete:
-            log.warning(f"Missing (skipping delete) {route}: {missing}")
 
         # summary
         title = route.strip('/').replace('/', '|').title()
@@ -460,24 +1000,153 @@ class API:
             #     log.warning("%-11s :: %s", title, status_text('unchanged', ' . '.join(f"{get_key(existing[k], *dk.split('.'))}" for dk in desc_keys)))
         return new, update, delete, unchanged
 
-    def diff_items(self, route, items, existing=None, forbidden_keys=None):
-        """Return a JSON-serializable create/update/delete plan without mutation."""
-        if existing is None:
-            existing = self.json('GET', route)['data']
-        forbidden_keys = set(forbidden_keys or []) | {'user_created', 'user_updated'}
+    def _create_layers(self, route, items, graph, layers, NEW='POST'):
+        """Create items layer by layer, retrying transient failures.
+
+        Items within a layer don't reference each other, so each layer is sent
+        in bulk and acts as a barrier for the next. An item is only sent once
+        all of its dependencies were created. Transient errors (5xx, 429,
+        network) are retried with jittered backoff; validation errors and items
+        blocked by a failed dependency are collected and raised together as a
+        ``BatchError`` once every layer has run.
+        """
+        done, failures = set(), {}
+        for layer in layers:
+            pending = []
+            for k in layer:
+                blocked = sorted((graph.get(k) or set()) - done, key=str)
+                if blocked:
+                    failures[k] = RuntimeError(f'blocked by {", ".join(map(str, blocked))}')
+                else:
+                    pending.append(k)
+
+            for attempt in range(self.create_retries + 1):
+                if attempt:
+                    delay = self.retry_backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+                    log.warning(f"🌱 Retrying {len(pending)} {route} item(s) in {delay:.1f}s")
+                    time.sleep(delay)
+                    # a request that timed out may still have been committed
+                    found = self._existing_ids(route, pending)
+                    done.update(found)
+                    pending = [k for k in pending if k not in found]
+                    if not pending:
+                        break
+                errors = self._send_creates(route, items, pending, NEW)
+                done.update(k for k in pending if k not in errors)
+                failures.update({k: e for k, e in errors.items() if not is_retryable(e)})
+                pending = [k for k, e in errors.items() if is_retryable(e)]
+                if not pending:
+                    break
+            failures.update({k: errors[k] for k in pending})
+        if failures:
+            raise BatchError(route, failures)
+        return done
 
-        def normalize(item):
-            return {key: value for key, value in item.items() if key not in forbidden_keys}
+    def _send_creates(self, route, items, keys, NEW='POST'):
+        if not callable(NEW):
+            return self._send_batches(NEW, route, [items[k] for k in keys])
+
+        def create(k):
+            try:
+                NEW(k, items[k])
+            except requests.exceptions.RequestException as e:
+                return k, e
+            return k, None
+        return {k: e for k, e in self._map(route, create, keys) if e is not None}
+
+    def _existing_ids(self, route, keys):
+        """Which of ``keys`` exist, read ``batch_size`` ids at a time.
+
+        Returns an empty set when that can't be read, so the items are sent again.
+        """
+        keys = list(keys)
+        if not keys or route == '/extensions':
+            return set()
+        self.invalidate(route)
+        size = max(1, self.batch_size or len(keys))
+        chunks = [keys[i:i + size] for i in range(0, len(keys), size)]
+        try:
+            pages = self._map(route, lambda chunk: self.fetch_all(
+                route, fields='id', filter=json.dumps({'id': {'_in': chunk}})), chunks)
+        except requests.exceptions.RequestException as e:
+            log.warning(f"🌱 Cannot check which {route} items were created ({e}); sending them again")
+            return set()
+        return {d['id'] for page in pages for d in page if 'id' in d} & set(keys)
 
-        desired = {str(item['id']): normalize(item) for item in items if 'id' in item}
-        current = {str(item['id']): normalize(item) for item in existing if 'id' in item}
+    def _send_batches(self, method, route, items, id_key='id'):
+        """Send items as array requests of at most ``batch_size`` items.
+
+        Returns ``{id: error}`` for the items that failed on their own.
+        """
+        size = max(1, self.batch_size or len(items) or 1)
+        chunks = [items[i:i + size] for i in range(0, len(items), size)]
+        errors = {}
+        for chunk_errors in self._map(route, lambda chunk: self._send_batch(method, route, chunk, id_key), chunks):
+            errors.update(chunk_errors)
+        return errors
+
+    def _map(self, route, fn, items):
+        """Call ``fn`` on independent items, up to ``concurrency`` at a time."""
+        items = list(items)
+        workers = min(self.concurrency, self.route_concurrency.get(_route_root(route), self.concurrency))
+        if workers <= 1 or len(items) <= 1:
+            return [fn(x) for x in items]
+        with ThreadPoolExecutor(max_workers=min(workers, len(items))) as pool:
+            return list(pool.map(fn, items))
+
+    def _send_batch(self, method, route, items, id_key='id'):
+        """Send items as one array request, bisecting the batch when rejected.
+
+        Directus applies an array payload in a single transaction, so a
+        rejected batch leaves nothing behind and can safely be split. Returns
+        ``{id: error}`` for the items that still fail on their own.
+        """
+        if not items:
+            return {}
+        try:
+            if len(items) > 1:
+                self.json(method, route, json=items)
+            elif method.upper() == 'PATCH':
+                self.json(method, f'{route}/{items[0][id_key]}', json=items[0])
+            else:
+                self.json(method, route, json=items[0])
+            return {}
+        except requests.exceptions.RequestException as e:
+            # transient failures say nothing about the payload, so don't split
+            if len(items) == 1 or is_retryable(e):
+                return {d[id_key]: e for d in items}
+            mid = len(items) // 2
+            return {
+                **self._send_batch(method, route, items[:mid], id_key),
+                **self._send_batch(method, route, items[mid:], id_key),
+            }
+
+    def diff_items(self, route, items, existing=None, forbidden_keys=None, digests=None):
+        """Return a JSON-serializable create/update/delete plan without mutation.
+
+        Items are compared by content digest first and only deep-compared when
+        the digests differ. ``digests`` may map current ids to digests that
+        were computed (or stored) earlier so they aren't hashed again.
+        """
+        if existing is None:
+            existing = self.fetch_all(route)
+        ignore = _ignored_keys(forbidden_keys)
+
+        desired = {str(item['id']): item for item in items if 'id' in item}
+        current = {str(item['id']): item for item in existing if 'id' in item}
         if len(desired) != len([item for item in items if 'id' in item]):
             raise ValueError(f'duplicate ids in desired state for {route}')
+        digests = digests or {}
+        current_digests = {
+            key: digests.get(key) or item_digest(item, ignore)
+            for key, item in current.items()
+        }
         return {
             'create': sorted(set(desired) - set(current)),
             'update': sorted(
                 key for key in set(desired) & set(current)
-                if desired[key] != current[key]
+                if item_digest(desired[key], ignore) != current_digests[key]
+                and _without(desired[key], ignore) != _without(current[key], ignore)
             ),
             'delete': sorted(set(current) - set(desired)),
         }
@@ -485,7 +1154,27 @@ class API:
     # -------------------------------- Collections ------------------------------- #
 
     def get_collections(self):
-        return self.json('GET', '/collections')['data']
+        return self.fetch('/collections')
+
+    # --------------------------------- Activity --------------------------------- #
+
+    def activity_since(self, watermark=None, collections=()):
+        """Which ``collections`` have activity after id ``watermark``.
+
+        Returns ``(changed, latest)``: the set of changed collections and the
+        newest activity id to use as the next watermark. A single aggregate
+        request, whatever the amount of activity. Revisions hang off activity
+        rows, so they need no separate check.
+        """
+        filters = [{'collection': {'_in': sorted(collections)}}] if collections else []
+        if watermark is not None:
+            filters.append({'id': {'_gt': watermark}})
+        params = {'aggregate[max]': 'id', 'groupBy[]': 'collection'}
+        if filters:
+            params['filter'] = json.dumps({'_and': filters})
+        rows = self.json('GET', '/activity', params=params)['data']
+        latest = max((int((row.get('max') or {}).get('id') or 0) for row in rows), default=0)
+        return {row['collection'] for row in rows}, max(latest, watermark or 0)
 
     # ---------------------------------------------------------------------------- #
     #                             Data synchronization                             #
@@ -522,16 +1211,75 @@ class API:
     def update_item(self, collection, key, data):
         return self.json('PATCH', f'/items/{collection}/{key}', json=data)
 
-    # def update_items(self, collection, data):
-    #     return [
-    #         self.json('PATCH', f'/items/{collection}/{d["id"]}', json=d)
-    #         for d in data
-    #     ]
+    def update_items(self, collection, data, key='id'):
+        """Update many items with bulk PATCHes of at most ``batch_size`` rows."""
+        errors = self._send_batches('PATCH', f'/items/{collection}', list(data), id_key=key)
+        if errors:
+            raise BatchError(f'/items/{collection}', errors)
+
+    def upsert_items(self, collection, data, key='id'):
+        """Create items in batches, bulk-updating the ones that already exist.
+
+        Which rows exist is read up front, a filtered read per ``batch_size``
+        keys, so a create that failed (e.g. on a timeout) is raised as a
+        ``BatchError`` instead of being taken for an existing row. Returns the
+        lists of created and updated keys.
+        """
+        data = list(data)
+        route = f'/items/{collection}'
+        size = max(1, self.batch_size or len(data) or 1)
+        chunks = [[d[key] for d in data[i:i + size]] for i in range(0, len(data), size)]
+        found = {
+            str(item.get(key))
+            for page in self._map(route, lambda keys: self.fetch_all(
+                route, fields=key, sort=key, filter=json.dumps({key: {'_in': keys}})), chunks)
+            for item in page
+        }
+        new = [d for d in data if str(d[key]) not in found]
+        existing = [d for d in data if str(d[key]) in found]
+        errors = self._send_batches('POST', route, new, id_key=key)
+        if errors:
+            raise BatchError(route, errors)
+        self.update_items(collection, existing, key=key)
+        return [d[key] for d in new], [d[key] for d in existing]
 
     def delete_items(self, collection, ids):
         return self.json('DELETE', f'/items/{collection}', json=ids)
 
 
+def _ignored_keys(forbidden_keys=None):
+    # XXX: is dropping user_created/updated desired? it's needed when copying between instances but we're losing this information
+    return frozenset(forbidden_keys or ()) | {'user_created', 'user_updated'}
+
+
+def _without(item, ignore):
+    return {k: v for k, v in item.items() if k not in ignore}
+
+
+def _protected_ids(route, existing):
+    """Ids that reconciliation must never delete from a route."""
+    if '/roles' in route:  # FIXME: this is janky
+        # Directus 11 reports the built-in Administrator role with
+        # ``admin_access: null``. Never remove protected roles, roles
+        # still assigned to users, or system roles during reconciliation.
+        return {
+            k for k, item in existing.items()
+            if item.get('admin_access') is not False
+            or item.get('system')
+            or item.get('users')
+        }
+    if '/policies' in route:
+        return {
+            k for k, item in existing.items()
+            if item.get('admin_access') is not False
+            or item.get('name') == '$t:public_label'
+            or item.get('system')
+            or item.get('roles')
+            or item.get('users')
+        }
+    return set()
+
+
 def sanitize_schema_null_collections(schema):
     dropped_collections = [c for c in schema['collections'] if c.get('meta', {}) is None]
     dropped_collection_names = [c['collection'] for c in dropped_collections]
@@ -0,0 +1,120 @@
+import os
+import gzip
+import json
+import hashlib
+import logging
+import threading
+import requests
+from requests.structures import CaseInsensitiveDict
+log = logging.getLogger(__name__.split('.')[0])
+
+# response headers worth keeping with a cached body
+KEPT_HEADERS = ('Content-Type', 'ETag', 'Last-Modified')
+
+
+class ResponseCache:
+    '''An on-disk cache of GET responses that are revalidated on every use.
+
+    Each entry is one gzip file: a JSON line of metadata followed by the raw
+    body. Entries with an ``ETag`` or ``Last-Modified`` validator are sent
+    back as ``If-None-Match``/``If-Modified-Since`` so that an unchanged
+    resource costs a bodiless 304. Without validators the body is downloaded
+    again, and its content hash saves rewriting an unchanged entry. The least
+    recently used entries are evicted once the directory exceeds ``max_bytes``.
+    Bodies may hold secrets (e.g. operation options), so only the owner can
+    read the entries (mode 0600, in a 0700 directory when it is created here).
+    '''
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(path, mode=0o700, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, f'{key}.gz')
+
+    def load(self, key):
+        """Return ``(meta, body)`` of an entry, or None."""
+        try:
+            with gzip.open(self._file(key), 'rb') as f:
+                meta = json.loads(f.readline())
+                return meta, f.read()
+        except (OSError, EOFError, ValueError):  # missing or truncated entry
+            return None
+
+    def validators(self, entry):
+        """Conditional request headers for a cached entry."""
+        if entry is None:
+            return {}
+        stored = entry[0].get('headers') or {}
+        headers = {}
+        if stored.get('ETag'):
+            headers['If-None-Match'] = stored['ETag']
+        if stored.get('Last-Modified'):
+            headers['If-Modified-Since'] = stored['Last-Modified']
+        return headers
+
+    def resolve(self, key, entry, response):
+        """Turn a 304 into the cached response, and store fresh 200s."""
+        if response.status_code == 304 and entry is not None:
+            meta, body = entry
+            log.debug('💾 %s not modified', response.url)
+            self._touch(key)
+            cached = requests.Response()
+            cached.status_code = 200
+            cached.url, cached.request = response.url, response.request
+            cached.headers = CaseInsensitiveDict(meta.get('headers') or {})
+            cached._content = body
+            return cached
+        if response.status_code == 200:
+            meta = {
+                'headers': {k: response.headers[k] for k in KEPT_HEADERS if k in response.headers},
+                'digest': hashlib.sha1(response.content).hexdigest(),
+            }
+            if entry is not None and entry[0] == meta:
+                self._touch(key)
+            else:
+                self.store(key, meta, response.content)
+        return response
+
+    def _touch(self, key):
+        # keeps recently used entries from eviction
+        try:
+            os.utime(self._file(key))
+        except FileNotFoundError:
+            pass
+
+    def store(self, key, meta, content):
+        tmp = f'{self._file(key)}.{threading.get_ident()}.tmp'
+        # created private, so the bodies are never readable by others, not even briefly
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as raw, gzip.open(raw, 'wb') as f:
+            f.write(json.dumps(meta).encode() + b'\n')
+            f.write(content)
+        os.replace(tmp, self._file(key))
+        self.evict()
+
+    def evict(self):
+        """Delete least recently used entries until under ``max_bytes``."""
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.path):
+                if name.endswith('.gz'):
+                    try:
+                        stat = os.stat(os.path.join(self.path, name))
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, name))
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except FileNotFoundError:
+                    pass
+                total -= size
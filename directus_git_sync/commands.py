@@ -1,68 +1,105 @@
+import copy
 import json
 import os
+import time
+import contextlib
 import glob
 import logging
 import requests
-from . import EXPORT_DIR, URL, EMAIL, PASSWORD
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from . import EXPORT_DIR, URL, EMAIL, PASSWORD, WORKERS, CONCURRENCY, TRANSPORT, INCREMENTAL, RECONCILE_INTERVAL, SERVE_PORT
 from .util import load_dir, pretty_print_schema_diff
 from .util import export_dir, export_one
-from .util import load_data, dump_data
-from .topo_sort import min_topological_sort, invert_graph
-from .api import API
+from .util import load_data, load_data_cached, dump_data, item_digest, pack_schema
+from .topo_sort import min_topological_sort, invert_graph, run_topological
+from .api import API, PROTECTION_KEYS, sanitize_schema_null_collections
+from .schema_diff import diff_schema, diff_unpacked_schema, filter_schema
+from .scope import Scope
+from .revision import head_commit, changed_paths, changed_scope
+from .serve import Trigger, watch_files, watch_signal, serve_http
 log = logging.getLogger(__name__)
 
 
+# ``depends_on`` lists the resource types an item may reference. They are
+# created first and deleted last; unrelated branches are applied concurrently.
 RESOURCE_CONFIG = {
     'policies': {'forbidden_keys': ['users', 'roles', 'permissions']},
-    'roles': {'forbidden_keys': ['users', 'children']},
-    'permissions': {},
+    'roles': {'forbidden_keys': ['users', 'children'], 'depends_on': ['policies']},
+    'permissions': {'depends_on': ['policies']},
     'flows': {'forbidden_keys': ['operations']},
-    'operations': {},
+    'operations': {'depends_on': ['flows']},
     'dashboards': {'forbidden_keys': ['panels']},
-    'panels': {},
-    'presets': {},
+    'panels': {'depends_on': ['dashboards']},
+    'presets': {'depends_on': ['roles']},
     'webhooks': {},
 }
 SETTINGS_IGNORED = {'id', 'project_id'}
 OPTIONAL_RESOURCES = {'panels', 'webhooks'}
+# what ``--only`` accepts besides collection globs
+SCOPE_TYPES = ['schema', 'settings', 'extensions', *RESOURCE_CONFIG]
+# resource types whose managed items are told apart by the exported policies
+POLICY_SCOPED = {'policies', 'roles', 'permissions'}
 
 
-def _load_configuration(src_dir):
-    required = ['settings.yaml', 'schema'] + [
-        name for name in RESOURCE_CONFIG if name not in OPTIONAL_RESOURCES
-    ] + ['extensions']
+def _scope(only=None):
+    return only if isinstance(only, Scope) else Scope(only, SCOPE_TYPES)
+
+
+def resource_graph(names=None):
+    """The ``depends_on`` graph over resource types (optionally a subset)."""
+    names = list(RESOURCE_CONFIG) if names is None else names
+    return {
+        name: {dep for dep in RESOURCE_CONFIG[name].get('depends_on', []) if dep in names}
+        for name in names
+    }
+
+
+def _load_configuration(src_dir, names=None):
+    """Load and validate a snapshot, or only the ``names`` parts of it.
+
+    Policies are also loaded when roles or permissions are, since those are
+    checked against them.
+    """
+    names = set(SCOPE_TYPES if names is None else names)
+    if names & POLICY_SCOPED:
+        names.add('policies')
+    required = [
+        name for name in ['settings.yaml', 'schema', *RESOURCE_CONFIG, 'extensions']
+        if name.removesuffix('.yaml') in names and name not in OPTIONAL_RESOURCES
+    ]
     missing = [name for name in required if not os.path.exists(os.path.join(src_dir, name))]
     if missing:
         raise ValueError('incomplete Directus snapshot; missing: ' + ', '.join(missing))
 
+    # parses are kept in memory, so loading an unchanged snapshot again is cheap
     resources = {
-        name: load_dir(os.path.join(src_dir, name))
-        for name in RESOURCE_CONFIG
+        name: load_dir(os.path.join(src_dir, name), cached=True)
+        for name in RESOURCE_CONFIG if name in names
     }
-    policies = {str(item['id']) for item in resources['policies']}
+    policies = {str(item['id']) for item in resources.get('policies', [])}
     referenced = {
         str(policy)
-        for role in resources['roles']
+        for role in resources.get('roles', [])
         for policy in role.get('policies', [])
     } | {
         str(item['policy'])
-        for item in resources['permissions']
+        for item in resources.get('permissions', [])
         if item.get('policy')
     }
     if referenced - policies:
         raise ValueError(
             'snapshot references policies that were not exported: '
             + ', '.join(sorted(referenced - policies)))
-    if any(role.get('users') for role in resources['roles']):
+    if any(role.get('users') for role in resources.get('roles', [])):
         raise ValueError('snapshot contains environment-specific role user bindings')
-    if any(item.get('user') for item in resources['presets']):
+    if any(item.get('user') for item in resources.get('presets', [])):
         raise ValueError('snapshot contains user-scoped presets')
 
     return {
-        'settings': load_data(os.path.join(src_dir, 'settings.yaml')),
-        'schema': load_dir(os.path.join(src_dir, 'schema'), as_dict=True),
+        'settings': load_data_cached(os.path.join(src_dir, 'settings.yaml')) if 'settings' in names else {},
+        'schema': load_dir(os.path.join(src_dir, 'schema'), as_dict=True, cached=True) if 'schema' in names else {},
         'resources': resources,
-        'extensions': load_dir(os.path.join(src_dir, 'extensions')),
+        'extensions': load_dir(os.path.join(src_dir, 'extensions'), cached=True) if 'extensions' in names else [],
     }
 
 
@@ -81,11 +118,151 @@ def _schema_has_changes(schema):
     return any(diff.get(name) for name in ('collections', 'fields', 'relations'))
 
 
-def build_plan(api, src_dir=EXPORT_DIR, force=False):
-    """Return a complete, non-mutating application-state plan."""
-    desired = _load_configuration(src_dir)
-    schema = api.diff_unpacked_schema(desired['schema'], force=force)
-    current_settings = api.export_settings()
+# Server-side form of the policy filter below; Directus stores admin_access as
+# a non-null boolean on policies.
+MANAGED_POLICIES = {'_and': [{'admin_access': {'_eq': False}}, {'name': {'_neq': '$t:public_label'}}]}
+MANAGED_PERMISSIONS = {'_and': [{'policy': rule} for rule in MANAGED_POLICIES['_and']]}
+# presets that aren't some user's own; GraphQL filters a many-to-one through
+# the related item's key
+GLOBAL_PRESETS = {'user': {'_null': True}}
+GLOBAL_PRESETS_GRAPHQL = {'user': {'id': {'_null': True}}}
+
+
+def _managed_query(api, name, policy_ids):
+    """Push the filters of ``_managed_actual`` and ``forbidden_keys`` to Directus."""
+    query = api.projection(f'/{name}', RESOURCE_CONFIG[name].get('forbidden_keys'))
+    filters = {
+        'policies': MANAGED_POLICIES,
+        'permissions': {'policy': {'_in': sorted(policy_ids)}},
+        'presets': GLOBAL_PRESETS,
+    }
+    if name in filters:
+        query['filter'] = json.dumps(filters[name])
+    return query
+
+
+def _remote_names(scope=None):
+    """Settings and the resource types in scope, i.e. the remote state to read."""
+    return [name for name in ['settings', *RESOURCE_CONFIG] if name in _scope(scope)]
+
+
+def _managed_graphql(api, policy_ids, names=None):
+    """Settings and the managed resources from one ``/graphql/system`` query."""
+    names = _remote_names() if names is None else names
+    return api.query_system({
+        **({'settings': {}} if 'settings' in names else {}),
+        **{
+            name: {
+                'exclude': (set(config.get('forbidden_keys') or []) | {'user_created', 'user_updated'}) - PROTECTION_KEYS,
+                # GraphQL filters a many-to-one through the related item's key
+                'filter': {
+                    'policies': MANAGED_POLICIES,
+                    'permissions': {'policy': {'id': {'_in': sorted(policy_ids)}}},
+                    'presets': GLOBAL_PRESETS_GRAPHQL,
+                }.get(name),
+            }
+            for name, config in RESOURCE_CONFIG.items() if name in names
+        },
+    })
+
+
+def _managed_actual(api, name, policy_ids, names=None):
+    if api.transport == 'graphql':
+        # the same query as ``_fetch_remote``, so it is answered from the cache
+        return _managed_items(name, _managed_graphql(api, policy_ids, names)[name], policy_ids)
+    return _managed_items(name, api.fetch_all(f'/{name}', **_managed_query(api, name, policy_ids)), policy_ids)
+
+
+def _managed_items(name, items, policy_ids):
+    # the client-side filters stay as a guard against servers ignoring a filter
+    if name == 'policies':
+        return [
+            item for item in items
+            if not item.get('admin_access') and item.get('name') != '$t:public_label'
+        ]
+    if name == 'roles':
+        return [
+            item for item in items
+            if set(map(str, item.get('policies', []))).issubset(policy_ids)
+        ]
+    if name == 'permissions':
+        return [
+            item for item in items
+            if not item.get('system') and str(item.get('policy')) in policy_ids
+        ]
+    if name == 'presets':
+        return [item for item in items if not item.get('user')]
+    return items
+
+
+def _fetch_remote(api, pool, policy_ids, names=None):
+    """Submit the reads of the managed remote state (``names``, default all) to ``pool``."""
+    names = _remote_names() if names is None else names
+    if api.transport == 'graphql':
+        # submitted first so that the tasks blocking on it can never starve it
+        everything = pool.submit(_managed_graphql, api, policy_ids, names)
+        return {
+            name: pool.submit(lambda name=name: (
+                everything.result()[name] if name == 'settings'
+                else _managed_items(name, everything.result()[name], policy_ids)))
+            for name in names
+        }
+    return {
+        name: pool.submit(api.export_settings) if name == 'settings'
+        else pool.submit(_managed_actual, api, name, policy_ids)
+        for name in names
+    }
+
+
+def _remote_digests(remote):
+    """Content digests of the managed remote state, ignoring runtime bindings."""
+    digests = {}
+    if 'settings' in remote:
+        digests['settings'] = {'settings': item_digest(remote['settings'], SETTINGS_IGNORED)}
+    for name, config in RESOURCE_CONFIG.items():
+        if name not in remote:
+            continue
+        ignore = set(config.get('forbidden_keys') or []) | {'user_created', 'user_updated'}
+        digests[name] = {
+            str(item['id']): item_digest(item, ignore)
+            for item in remote[name] if 'id' in item
+        }
+    return digests
+
+
+def build_plan(api, src_dir=EXPORT_DIR, force=False, workers=WORKERS, payloads=False, local_schema=False, only=None):
+    """Return a complete, non-mutating application-state plan.
+    
+    The schema diff and every remote read are independent, so they are issued
+    together on a pool of at most ``workers`` threads. With ``payloads`` the
+    plan also carries the items to send, so ``apply --plan`` can run it as is.
+    With ``local_schema`` the schema is diffed here against the server's
+    snapshot instead of by ``/schema/diff``. ``only`` limits the plan to some
+    resource types and collections (see ``Scope``); nothing else is read.
+    """
+    scope = _scope(only)
+    names = _remote_names(scope)
+    desired = _load_configuration(src_dir, [name for name in SCOPE_TYPES if name in scope])
+    policy_ids = {str(item['id']) for item in desired['resources'].get('policies', [])}
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        schema = installed = None
+        if 'schema' not in scope:
+            pass
+        elif local_schema:
+            keep = scope.collections or (lambda name: True)
+            schema = pool.submit(lambda: diff_schema(
+                filter_schema(api.export_schema(), keep),
+                filter_schema(sanitize_schema_null_collections(pack_schema(copy.deepcopy(desired['schema']))), keep)))
+        else:
+            schema = pool.submit(api.diff_unpacked_schema, desired['schema'], force=force, collections=scope.collections)
+        remote = _fetch_remote(api, pool, policy_ids, names)
+        if 'extensions' in scope:
+            installed = pool.submit(api.export_extensions)
+    schema = schema and schema.result()
+    remote = {key: future.result() for key, future in remote.items()}
+    current_settings = remote.get('settings', {})
+
     desired_settings = {
         key: value for key, value in desired['settings'].items()
         if key not in SETTINGS_IGNORED
@@ -95,41 +272,19 @@ def build_plan(api, src_dir=EXPORT_DIR, force=False):
         for key, value in desired_settings.items()
         if current_settings.get(key) != value
     }
-    policy_ids = {str(item['id']) for item in desired['resources']['policies']}
-
-    def managed_actual(name):
-        items = api.json('GET', f'/{name}')['data']
-        if name == 'policies':
-            return [
-                item for item in items
-                if not item.get('admin_access') and item.get('name') != '$t:public_label'
-            ]
-        if name == 'roles':
-            return [
-                item for item in items
-                if set(map(str, item.get('policies', []))).issubset(policy_ids)
-            ]
-        if name == 'permissions':
-            return [
-                item for item in items
-                if not item.get('system') and str(item.get('policy')) in policy_ids
-            ]
-        if name == 'presets':
-            return [item for item in items if not item.get('user')]
-        return items
-
+    digests = _remote_digests(remote)
     resources = {
         name: api.diff_items(
             f'/{name}',
-            items,
-            existing=managed_actual(name),
-            forbidden_keys=config.get('forbidden_keys'))
-        for name, config in RESOURCE_CONFIG.items()
-        for items in [desired['resources'][name]]
+            desired['resources'][name],
+            existing=remote[name],
+            forbidden_keys=config.get('forbidden_keys'),
+            digests=digests[name])
+        for name, config in RESOURCE_CONFIG.items() if name in remote
     }
     installed = {
         item.get('schema', {}).get('name'): item.get('schema', {}).get('version')
-        for item in api.export_extensions()
+        for item in (installed.result() if installed else [])
     }
     extensions_missing = sorted(
         f"{item.get('schema', {}).get('name')}@{item.get('schema', {}).get('version')}"
@@ -140,122 +295,581 @@ def build_plan(api, src_dir=EXPORT_DIR, force=False):
         changes['delete'] for changes in resources.values())
     has_changes = bool(_schema_has_changes(schema) or settings or extensions_missing) or any(
         any(changes.values()) for changes in resources.values())
-    return {
+    plan = {
         'schema': schema,
         'settings': settings,
         'resources': resources,
         'extensions_missing': extensions_missing,
         'destructive': bool(destructive),
         'has_changes': bool(has_changes),
+        'fingerprint': {'digest': item_digest(digests), 'policy_ids': sorted(policy_ids)},
     }
+    if scope.only:
+        plan['only'] = scope.only
+    if payloads:
+        plan['digests'] = digests
+        plan['payloads'] = {}
+        for name, changes in resources.items():
+            wanted = {str(item['id']): item for item in desired['resources'][name] if 'id' in item}
+            current = {str(item['id']): item for item in remote[name] if 'id' in item}
+            plan['payloads'][name] = {
+                'create': [wanted[key] for key in changes['create']],
+                'update': [wanted[key] for key in changes['update']],
+                'delete': [current[key] for key in changes['delete']],
+            }
+    return plan
+
+
+def _verify_touched(api, desired, touched, force=False, only=None):
+    """Re-read only what a run mutated and compare it with the desired state.
+
+    ``touched`` maps routes to the ids ``API.json`` saw in mutation requests
+    and responses. Returns the remaining differences (empty when converged).
+    """
+    scope = _scope(only)
+    problems = {}
+    if '/schema' in touched and desired['schema'] is not None:
+        schema = api.diff_unpacked_schema(desired['schema'], force=force, collections=scope.collections)
+        if _schema_has_changes(schema):
+            problems['schema'] = schema
+    if '/settings' in touched:
+        api.invalidate('/settings')
+        current = api.export_settings()
+        settings = {
+            key: {'current': current.get(key), 'desired': value}
+            for key, value in desired['settings'].items()
+            if key not in SETTINGS_IGNORED and current.get(key) != value
+        }
+        if settings:
+            problems['settings'] = settings
+    for name, config in RESOURCE_CONFIG.items():
+        ids = sorted(touched.get(f'/{name}') or ())
+        if not ids:
+            continue
+        api.invalidate(f'/{name}')
+        # a read per ``batch_size`` ids keeps the query string short
+        size = max(1, api.batch_size or len(ids))
+        current = [
+            item
+            for i in range(0, len(ids), size)
+            for item in api.fetch_all(f'/{name}', filter=json.dumps({'id': {'_in': ids[i:i + size]}}))
+        ]
+        changes = api.diff_items(
+            f'/{name}',
+            [item for item in desired['resources'].get(name, []) if str(item.get('id')) in ids],
+            existing=[item for item in current if str(item.get('id')) in ids],
+            forbidden_keys=config.get('forbidden_keys'))
+        if any(changes.values()):
+            problems[name] = changes
+    return problems
+
+
+def _planned_configuration(plan):
+    """The desired state a saved plan leads to, in the shape of ``_load_configuration``.
+
+    Resources hold only the planned creates and updates, so planned deletes
+    are expected to be gone. The schema is None: its diff carries the
+    server's hash and was either applied as a whole or rejected.
+    """
+    return {
+        'settings': {key: value['desired'] for key, value in plan['settings'].items()},
+        'schema': None,
+        'resources': {
+            name: changes['create'] + changes['update']
+            for name, changes in plan['payloads'].items()
+        },
+        'extensions': [],
+    }
+
+
+def _planned_ids(plan):
+    """Every route and id a saved plan changes, like ``API.touched``."""
+    touched = {
+        f'/{name}': {str(item['id']) for items in changes.values() for item in items if 'id' in item}
+        for name, changes in plan['payloads'].items()
+    }
+    if plan['settings']:
+        touched['/settings'] = set()
+    return touched
+
+
+def _apply_resources(create_or_update, delete, workers=WORKERS, names=None):
+    """Create and update along the resource DAG, then delete in reverse.
+
+    This avoids deleting a policy while a permission still refers to it.
+    Settings depend on nothing and run alongside the resources. ``names``
+    limits both to some resource types (and settings).
+    """
+    names = _remote_names() if names is None else names
+    graph = resource_graph([name for name in RESOURCE_CONFIG if name in names])
+    run_topological({**({'settings': set()} if 'settings' in names else {}), **graph}, create_or_update, workers)
+    run_topological(invert_graph(graph), delete, workers)
+
+
+def _apply_saved_plan(api, plan, workers=WORKERS):
+    """Run exactly the operations of a ``diff --output`` plan.
+
+    The remote state is re-read once and must still match the plan's
+    fingerprint. The schema diff carries Directus' own snapshot hash, so a
+    stale schema diff is rejected by the server.
+    """
+    fingerprint = plan.get('fingerprint') or {}
+    if 'payloads' not in plan or 'digest' not in fingerprint:
+        raise ValueError('plan has no payloads; re-create it with directus-git-sync diff --output')
+    if plan['extensions_missing']:
+        raise ValueError(
+            'required extension builds are not installed: '
+            + ', '.join(plan['extensions_missing']))
+    if _schema_has_changes(plan['schema']) and not plan['schema'].get('hash'):
+        raise ValueError('the plan has a locally computed schema diff; re-create it without --local-schema')
+    names = _remote_names(plan.get('only'))
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        remote = _fetch_remote(api, pool, set(fingerprint['policy_ids']), names)
+    remote = {key: future.result() for key, future in remote.items()}
+    digests = _remote_digests(remote)
+    if item_digest(digests) != fingerprint['digest']:
+        planned = plan.get('digests') or {}
+        changed = [
+            f'{name}/{key}'
+            for name in digests
+            for key in sorted(set(digests[name]) | set(planned.get(name, {})))
+            if digests[name].get(key) != planned.get(name, {}).get(key)
+        ]
+        raise ValueError(
+            'Directus changed since the plan was made; re-run directus-git-sync diff'
+            + (f' (changed: {", ".join(changed)})' if changed else ''))
 
+    if _schema_has_changes(plan['schema']):
+        pretty_print_schema_diff(plan['schema'])
+        api.apply_schema(plan['schema'])
+    payloads = plan['payloads']
 
-def diff(email=EMAIL, password=PASSWORD, url=URL, src_dir=EXPORT_DIR, force: 'bool'=False, output=None):
-    """Plan all managed Directus configuration without changing the server."""
+    def create_or_update(name):
+        if name == 'settings':
+            return api.apply_settings({key: value['desired'] for key, value in plan['settings'].items()})
+        return api.apply_planned(
+            f'/{name}', {key: payloads[name][key] for key in ('create', 'update')},
+            forbidden_keys=RESOURCE_CONFIG[name].get('forbidden_keys'))
+
+    def delete(name):
+        # protection is decided on the state just read, which the
+        # fingerprint can't vouch for: it ignores runtime bindings like users
+        return api.apply_planned(
+            f'/{name}', {'delete': payloads[name]['delete']}, existing=remote[name],
+            forbidden_keys=RESOURCE_CONFIG[name].get('forbidden_keys'))
+
+    _apply_resources(create_or_update, delete, workers, names)
+
+
+def diff(email=EMAIL, password=PASSWORD, url=URL, src_dir=EXPORT_DIR, force: 'bool'=False, output=None, workers: 'int'=WORKERS, transport=TRANSPORT, local_schema: 'bool'=False, only=None):
+    """Plan all managed Directus configuration without changing the server.
+    
+    ``--output plan.json`` also saves the item payloads for ``apply --plan``.
+    ``--transport graphql`` reads the managed resources in one request.
+    ``--local-schema`` diffs the schema here instead of on the server; the
+    result has no server hash, so ``apply --plan`` will not accept it.
+    ``--only flows,operations`` or ``--only 'sensor_*'`` plans just those
+    resource types or collections.
+    """
     assert url and email and password, "missing url and/or credentials"
     log.info(f"Planning Directus configuration for {url}")
     log.info(f"Loading from {src_dir}\n")
 
-    api = API(url)
+    api = API(url, transport=transport)
     api.login(email, password)
 
-    result = build_plan(api, src_dir, force=force)
-    rendered = json.dumps(result, indent=2, sort_keys=True)
+    result = build_plan(
+        api, src_dir, force=force, workers=workers, payloads=bool(output),
+        local_schema=local_schema, only=only)
     if output:
         with open(output, 'w') as stream:
-            stream.write(rendered + '\n')
-    print(rendered)
+            stream.write(json.dumps(result, indent=2, sort_keys=True, default=str) + '\n')
+    # the payloads and per-item digests are for ``apply --plan``; stdout stays a summary
+    print(json.dumps({k: v for k, v in result.items() if k not in ('payloads', 'digests')}, indent=2, sort_keys=True))
     return result
 
 
-def apply(email=EMAIL, password=PASSWORD, url=URL, src_dir=EXPORT_DIR, force: 'bool'=False, yes: 'bool'=False):
-    """Apply all managed Directus configuration after an explicit approval."""
+# system collections whose activity means that a resource type may have drifted
+ACTIVITY_SCOPE = {
+    'directus_collections': 'schema',
+    'directus_fields': 'schema',
+    'directus_relations': 'schema',
+    'directus_settings': 'settings',
+    'directus_extensions': 'extensions',
+    'directus_access': 'roles',  # role-policy links
+    **{f'directus_{name}': name for name in RESOURCE_CONFIG},
+}
+
+
+def _revision_scope(applied, src_dir):
+    """What changed in ``src_dir`` since the ``applied`` commit, as ``--only`` tokens.
+
+    Returns None when that is unknown: there is no record of an earlier apply
+    from this directory, or it can't be diffed against.
+    """
+    if applied.get('src_dir') != os.path.abspath(src_dir) or not applied.get('commit'):
+        return None
+    paths = changed_paths(src_dir, applied['commit'])
+    return None if paths is None else changed_scope(paths, SCOPE_TYPES)
+
+
+def _activity_scope(api, watermark=None):
+    """The resource types edited in Directus after activity id ``watermark``.
+
+    Returns ``(tokens, latest)``, where ``latest`` is the next watermark.
+    ``tokens`` is None when unknown: without a watermark, or when the
+    activity log can't be read.
+    """
+    try:
+        changed, latest = api.activity_since(watermark, ACTIVITY_SCOPE)
+    except requests.exceptions.RequestException as e:
+        log.warning("Cannot read the activity log (%s); reconciling everything.", e)
+        return None, None
+    if watermark is None:
+        return None, latest
+    return sorted({ACTIVITY_SCOPE[name] for name in changed if name in ACTIVITY_SCOPE}), latest
+
+
+def _record_revision(api, src_dir, commit, reconciled=False, activity=None):
+    applied = api.state.get('applied') or {}
+    api.state.update(applied={
+        'src_dir': os.path.abspath(src_dir),
+        'commit': commit,
+        'reconciled': time.time() if reconciled else applied.get('reconciled', 0),
+        'activity': applied.get('activity') if activity is None else activity,
+    })
+
+
+def _reconcile(api, email, password, src_dir=EXPORT_DIR, force=False, workers=WORKERS, plan=None, verify='touched', schema_chunk=0, only=None, incremental=INCREMENTAL, reconcile_interval=RECONCILE_INTERVAL):
+    """One ``apply`` run with a given client, which is logged in if needed.
+
+    Runs that share a state directory never overlap, also across processes.
+    """
+    api.touched = {}
+    with api.state.lock() if api.state is not None else contextlib.nullcontext():
+        commit = watermark = None
+        reconciled = False
+        if incremental and not plan and only is None:
+            # read before the files, so that a checkout during the run is seen next time
+            commit = head_commit(src_dir) if api.state is not None else None
+            if api.state is None:
+                log.warning("--incremental needs DIRECTUS_STATE_DIR; applying everything.")
+            elif commit:
+                applied = api.state.get('applied') or {}
+                only = _revision_scope(applied, src_dir)
+                if only is None or time.time() - applied.get('reconciled', 0) >= reconcile_interval:
+                    # a reconcile, which also catches up with edits made in Directus.
+                    # Our own edits show up in the next one, and cost a no-op plan.
+                    if api.identity is None:
+                        api.login(email, password)
+                    edited, watermark = _activity_scope(api, applied.get('activity'))
+                    if only and edited and 'schema' in edited:
+                        # the whole schema, not just the collections changed in git
+                        only = [token for token in only if token in SCOPE_TYPES]
+                    only = None if only is None or edited is None else sorted({*only, *edited})
+                    reconciled = True
+                if only == []:
+                    log.info("Nothing changed in git or Directus since the last run.")
+                    _record_revision(api, src_dir, commit, reconciled, watermark)
+                    return {'verify': verify, 'touched': {}, 'only': []}
+                log.info("Applying changes since the last run: %s", ','.join(only or ['everything']))
+        if api.identity is None:
+            api.login(email, password)
+        scope = _scope(only)
+        names = _remote_names(scope)
+        parts = [name for name in SCOPE_TYPES if name in scope]
+
+        # every phase below reads remote state through the same run-scoped cache
+        with api.cached():
+            if plan:
+                plan = load_data(plan)
+                scope = _scope(plan.get('only'))
+                parts = [name for name in SCOPE_TYPES if name in scope]
+                _apply_saved_plan(api, plan, workers)
+            else:
+                desired = _load_configuration(src_dir, parts)
+                before = build_plan(api, src_dir, force=force, workers=workers, only=scope)
+                if before['extensions_missing']:
+                    raise ValueError(
+                        'required extension builds are not installed: '
+                        + ', '.join(before['extensions_missing']))
+                if 'schema' in scope:
+                    api.diff_apply_unpacked_schema(
+                        desired['schema'], force=force, yes=True, chunk_size=schema_chunk,
+                        collections=scope.collections)
+
+                # apply against the managed remote state that was planned, which
+                # is also the read the plan left in the cache
+                policy_ids = set(before['fingerprint']['policy_ids'])
+
+                def create_or_update(name):
+                    if name == 'settings':
+                        return api.apply_settings({
+                            key: value for key, value in desired['settings'].items()
+                            if key not in SETTINGS_IGNORED
+                        })
+                    return getattr(api, f'apply_{name}')(
+                        desired['resources'][name], allow_delete=False,
+                        existing=_managed_actual(api, name, policy_ids, names))
+
+                def delete(name):
+                    return getattr(api, f'apply_{name}')(
+                        desired['resources'][name], allow_delete=True,
+                        existing=_managed_actual(api, name, policy_ids, names))
+
+                _apply_resources(create_or_update, delete, workers, names)
+
+            if plan:
+                # checked against the plan itself; src_dir may be absent or at another commit
+                touched = {route: sorted(ids) for route, ids in api.touched.items()}
+                if verify != 'none':
+                    problems = _verify_touched(
+                        api, _planned_configuration(plan),
+                        _planned_ids(plan) if verify == 'full' else api.touched, force=force)
+                    if problems:
+                        raise RuntimeError('Directus configuration did not converge: ' + json.dumps(problems, sort_keys=True))
+                result = {'verify': verify, 'touched': touched}
+            elif verify == 'full':
+                result = build_plan(api, src_dir, force=force, workers=workers, only=scope)
+                if result['has_changes']:
+                    raise RuntimeError('Directus configuration did not converge: ' + json.dumps(result, sort_keys=True))
+            else:
+                touched = {route: sorted(ids) for route, ids in api.touched.items()}
+                if verify == 'touched':
+                    problems = _verify_touched(
+                        api, _load_configuration(src_dir, parts), api.touched, force=force, only=scope)
+                    if problems:
+                        raise RuntimeError('Directus configuration did not converge: ' + json.dumps(problems, sort_keys=True))
+                result = {'verify': verify, 'touched': touched}
+        if commit:
+            _record_revision(api, src_dir, commit, reconciled, watermark)
+        return result
+
+
+def apply(email=EMAIL, password=PASSWORD, url=URL, src_dir=EXPORT_DIR, force: 'bool'=False, yes: 'bool'=False, workers: 'int'=WORKERS, concurrency: 'int'=CONCURRENCY, plan=None, verify: 'str'='touched', transport=TRANSPORT, schema_chunk: 'int'=0, only=None, incremental: 'bool'=INCREMENTAL, reconcile_interval: 'float'=RECONCILE_INTERVAL):
+    """Apply all managed Directus configuration after an explicit approval.
+    
+    ``--concurrency N`` sends up to N independent requests of a dependency
+    layer at once. ``--plan plan.json`` runs a plan saved by ``diff --output``
+    instead of planning again. ``--verify`` checks convergence afterwards by
+    re-reading only what was changed (``touched``), re-planning everything
+    (``full``), or not at all (``none``); with ``--plan`` both compare with
+    the plan rather than ``src_dir``, ``full`` re-reading every planned
+    item. ``--transport graphql`` reads the
+    managed resources in one request. ``--schema-chunk N`` applies a schema
+    diff N collections or relations at a time instead of in one request.
+    ``--only`` limits the run to some resource types and collections, like
+    ``diff --only``; a saved plan keeps the scope it was made with.
+
+    ``--incremental`` (needs ``DIRECTUS_STATE_DIR``) records the git commit of
+    ``src_dir`` after each successful run and next time applies only what
+    changed since, as if given ``--only``. Every ``--reconcile-interval``
+    seconds it also re-applies the resource types that the Directus activity
+    log shows were edited since the last reconcile, and everything when the
+    log can't tell.
+    """
     assert url and email and password, "missing url and/or credentials"
     if not yes:
         raise ValueError('refusing apply without --yes after reviewing directus-git-sync diff')
+    if verify not in ('full', 'touched', 'none'):
+        raise ValueError(f'--verify must be one of full, touched, none; got {verify!r}')
     log.info(f"Applying Directus configuration to {url}")
-    log.info(f"Loading from {src_dir}\n")
+    log.info(f"Loading from {plan or src_dir}\n")
 
-    api = API(url)
-    api.login(email, password)
+    api = API(url, concurrency=concurrency, transport=transport)
+    return _reconcile(
+        api, email, password, src_dir, force=force, workers=workers, plan=plan, verify=verify,
+        schema_chunk=schema_chunk, only=only, incremental=incremental, reconcile_interval=reconcile_interval)
 
-    desired = _load_configuration(src_dir)
-    before = build_plan(api, src_dir, force=force)
-    if before['extensions_missing']:
-        raise ValueError(
-            'required extension builds are not installed: '
-            + ', '.join(before['extensions_missing']))
-    api.diff_apply_unpacked_schema(desired['schema'], force=force, yes=True)
-    api.apply_settings({
-        key: value for key, value in desired['settings'].items()
-        if key not in SETTINGS_IGNORED
-    })
 
-    # Create and update dependencies first, then delete in reverse dependency
-    # order. This avoids deleting a policy while a permission still refers to it.
-    for name, config in RESOURCE_CONFIG.items():
-        getattr(api, f'apply_{name}')(
-            desired['resources'][name],
-            allow_delete=False)
-    for name, config in reversed(RESOURCE_CONFIG.items()):
-        getattr(api, f'apply_{name}')(
-            desired['resources'][name],
-            allow_delete=True)
+def serve(email=EMAIL, password=PASSWORD, url=URL, src_dir=EXPORT_DIR, force: 'bool'=False, yes: 'bool'=False, workers: 'int'=WORKERS, concurrency: 'int'=CONCURRENCY, verify: 'str'='touched', transport=TRANSPORT, schema_chunk: 'int'=0, reconcile_interval: 'float'=RECONCILE_INTERVAL, debounce: 'float'=5, poll: 'float'=2, host='127.0.0.1', port: 'int'=SERVE_PORT):
+    """Keep Directus in sync with ``src_dir`` from one long-running process.
+
+    Applies like ``apply --yes`` at start and then whenever files under
+    ``src_dir`` change (checked every ``--poll`` seconds), on ``SIGHUP``, on
+    ``POST /reconcile`` to ``--host``:``--port`` (``--port 0`` disables it),
+    and at least every ``--reconcile-interval`` seconds. Triggers within
+    ``--debounce`` seconds of each other make one run, and runs never overlap.
+    The login and the parsed snapshot are kept between runs, and with
+    ``DIRECTUS_STATE_DIR`` each run is incremental (see ``apply``).
+    ``GET /status`` reports the last run.
+    """
+    assert url and email and password, "missing url and/or credentials"
+    if not yes:
+        raise ValueError('refusing to serve without --yes after reviewing directus-git-sync diff')
+    if verify not in ('full', 'touched', 'none'):
+        raise ValueError(f'--verify must be one of full, touched, none; got {verify!r}')
+    log.info(f"Serving Directus configuration from {src_dir} to {url}")
 
-    after = build_plan(api, src_dir, force=force)
-    if after['has_changes']:
-        raise RuntimeError('Directus configuration did not converge: ' + json.dumps(after, sort_keys=True))
-    return after
+    api = API(url, concurrency=concurrency, transport=transport)
+    api.login(email, password)
+    trigger = Trigger(debounce)
+    status = {'runs': 0, 'last': None}
+    watch_files(src_dir, trigger, poll)
+    watch_signal(trigger)
+    server = serve_http(trigger, lambda: dict(status), host, port) if port else None
+    reasons = {'start'}
+    try:
+        while True:
+            log.info("Reconciling (%s)", ', '.join(sorted(reasons)))
+            started = time.time()
+            try:
+                result = _reconcile(
+                    api, email, password, src_dir, force=force, workers=workers, verify=verify,
+                    schema_chunk=schema_chunk, incremental=api.state is not None,
+                    # a timed run is the reconcile
+                    reconcile_interval=0 if reasons == {'interval'} else reconcile_interval)
+                status['last'] = {'started': started, 'ok': True, 'touched': result.get('touched')}
+            except Exception as e:  # keep serving, the next trigger retries
+                log.exception("Reconcile failed")
+                status['last'] = {'started': started, 'ok': False, 'error': str(e)}
+            status['runs'] += 1
+            reasons = trigger.wait(reconcile_interval) or {'interval'}
+    except KeyboardInterrupt:
+        log.info("Stopping.")
+    finally:
+        if server is not None:
+            server.shutdown()
 
 
-def export(email=EMAIL, password=PASSWORD, url=URL, out_dir=EXPORT_DIR):
-    '''Dump the configuration of a Directus to disk (to be committed to git).'''
+def export(email=EMAIL, password=PASSWORD, url=URL, out_dir=EXPORT_DIR, workers: 'int'=WORKERS, transport=TRANSPORT, only=None):
+    '''Dump the configuration of a Directus to disk (to be committed to git).
+    
+    Every resource is fetched concurrently (``--workers 1`` to run serially)
+    and written as soon as it arrives. Only roles and permissions wait for the
+    policies fetch, since they are filtered by the exported policy ids.
+    ``--transport graphql`` reads settings and resources in one request.
+    ``--only`` exports just some resource types, or the schema of the
+    collections matching a glob; everything else on disk is left alone.
+    '''
     assert url and email and password, "missing url and credentials"
     log.info(f"Exporting Directus schema and flows from {url}")
     log.info(f"Saving to {out_dir}\n")
 
-    api = API(url)
+    scope = _scope(only)
+    api = API(url, transport=transport)
     api.login(email, password)
     os.makedirs(out_dir, exist_ok=True)
     for name in list(RESOURCE_CONFIG) + ['schema', 'extensions']:
-        os.makedirs(os.path.join(out_dir, name), exist_ok=True)
-    export_one({
-        key: value for key, value in api.export_settings().items()
-        if key not in SETTINGS_IGNORED
-    }, out_dir, 'settings')
-    # export_one(api.export_user_mapping(), out_dir, 'users')
-    # export_one(api.export_schema(), out_dir, 'schema')
-    export_dir(api.export_unpacked_schema(), out_dir, 'schema')
-    export_dir(api.export_flows(), out_dir, 'flows')
-    export_dir(api.export_operations(), out_dir, 'operations')
-    export_dir(api.export_dashboards(), out_dir, 'dashboards')
-    export_dir(api.export_panels(), out_dir, 'panels')
-    export_dir(api.export_webhooks(), out_dir, 'webhooks')
-    export_dir([
-        item for item in api.export_presets()
-        if not item.get('user')
-    ], out_dir, 'presets', ['bookmark', 'collection', 'id'])
-    export_dir(api.export_extensions(), out_dir, 'extensions', ['schema.name', 'schema.type'])
-    policies = [
-        {
-            key: value for key, value in item.items()
-            if key not in ['users', 'roles', 'permissions']
+        if name in scope:
+            os.makedirs(os.path.join(out_dir, name), exist_ok=True)
+    # roles and permissions are exported for the managed policies
+    wanted = set(_remote_names(scope)) | ({'policies'} if POLICY_SCOPED & set(_remote_names(scope)) else set())
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        if api.transport == 'graphql':
+            # submitted first so that the reads blocking on it can never starve it
+            everything = pool.submit(api.query_system, {name: query for name, query in {
+                'settings': {}, 'flows': {}, 'operations': {}, 'dashboards': {},
+                'panels': {}, 'webhooks': {}, 'presets': {'filter': GLOBAL_PRESETS_GRAPHQL},
+                'policies': {'exclude': ['users', 'roles', 'permissions'], 'filter': MANAGED_POLICIES},
+                'roles': {'exclude': ['users', 'children']},
+                'permissions': {'filter': MANAGED_PERMISSIONS},
+            }.items() if name in wanted})
+            read = {
+                name: (lambda name=name: everything.result()[name])
+                for name in ['settings', 'policies', *RESOURCE_CONFIG]
+            }
+        else:
+            read = {
+                'settings': api.export_settings,
+                'flows': api.export_flows,
+                'operations': api.export_operations,
+                'dashboards': api.export_dashboards,
+                'panels': api.export_panels,
+                'webhooks': api.export_webhooks,
+                'presets': lambda: api.export_presets(filter=json.dumps(GLOBAL_PRESETS)),
+                'policies': lambda: api.export_policies(
+                    filter=json.dumps(MANAGED_POLICIES),
+                    **api.projection('/policies', ['users', 'roles', 'permissions'], keep=())),
+                'roles': lambda: api.export_roles(**api.projection('/roles', ['users', 'children'], keep=())),
+                # filtered on the related policy so this doesn't wait for the policies fetch
+                'permissions': lambda: api.export_permissions(filter=json.dumps(MANAGED_PERMISSIONS)),
+            }
+
+        # submitted first so that dependents blocking on it can never starve it
+        policies = pool.submit(lambda: [
+            {
+                key: value for key, value in item.items()
+                if key not in ['users', 'roles', 'permissions']
+            }
+            for item in read['policies']()
+            if not item.get('admin_access') and item.get('name') != '$t:public_label'
+        ] if 'policies' in wanted else [])
+
+        def policy_ids():
+            return {str(item['id']) for item in policies.result()}
+
+        def export_settings():
+            export_one({
+                key: value for key, value in read['settings']().items()
+                if key not in SETTINGS_IGNORED
+            }, out_dir, 'settings')
+
+        def export_presets():
+            export_dir([
+                item for item in read['presets']()
+                if not item.get('user')
+            ], out_dir, 'presets', ['bookmark', 'collection', 'id'])
+
+        def export_roles():
+            roles = read['roles']()
+            ids = policy_ids()
+            export_dir([
+                {key: value for key, value in item.items() if key not in ['users', 'children']}
+                for item in roles
+                if set(map(str, item.get('policies', []))).issubset(ids)
+            ], out_dir, 'roles', ['name', 'id'])
+
+        def export_permissions():
+            permissions = read['permissions']()
+            ids = policy_ids()
+            export_dir([
+                d for d in permissions
+                if d.get('system') is not True and 'id' in d
+                and str(d.get('policy')) in ids
+            ], out_dir, 'permissions', keys=['policy', 'action', 'collection', 'id'])
+
+        def export_schema():
+            schema = api.export_unpacked_schema()
+            if scope.globs:
+                # other collections' files stay as they are
+                schema = {key: value for key, value in schema.items() if key == '__meta__' or scope.matches(key)}
+            export_dir(schema, out_dir, 'schema', prune=not scope.globs)
+
+        tasks = {
+            # the schema snapshot is the slowest request, so start it first
+            'schema': export_schema,
+            'settings': export_settings,
+            'flows': lambda: export_dir(read['flows'](), out_dir, 'flows'),
+            'operations': lambda: export_dir(read['operations'](), out_dir, 'operations'),
+            'dashboards': lambda: export_dir(read['dashboards'](), out_dir, 'dashboards'),
+            'panels': lambda: export_dir(read['panels'](), out_dir, 'panels'),
+            'webhooks': lambda: export_dir(read['webhooks'](), out_dir, 'webhooks'),
+            'presets': export_presets,
+            'extensions': lambda: export_dir(api.export_extensions(), out_dir, 'extensions', ['schema.name', 'schema.type']),
+            'policies': lambda: export_dir(policies.result(), out_dir, 'policies', ['name', 'id']),
+            'roles': export_roles,
+            'permissions': export_permissions,
         }
-        for item in api.export_policies()
-        if not item.get('admin_access') and item.get('name') != '$t:public_label'
-    ]
-    policy_ids = {str(item['id']) for item in policies}
-    export_dir(policies, out_dir, 'policies', ['name', 'id'])
-    export_dir([
-        {key: value for key, value in item.items() if key not in ['users', 'children']}
-        for item in api.export_roles()
-        if set(map(str, item.get('policies', []))).issubset(policy_ids)
-    ], out_dir, 'roles', ['name', 'id'])
-    export_dir([
-        d for d in api.export_permissions()
-        if d.get('system') is not True and 'id' in d
-        and str(d.get('policy')) in policy_ids
-    ], out_dir, 'permissions', keys=['policy', 'action', 'collection', 'id'])
+        # export_one(api.export_user_mapping(), out_dir, 'users')
+        # export_one(api.export_schema(), out_dir, 'schema')
+        for future in as_completed([pool.submit(task) for name, task in tasks.items() if name in scope]):
+            future.result()
+
+
+def diff_schema_dirs(base_dir, src_dir=EXPORT_DIR):
+    '''Diff the schema of two exported snapshots offline, without a server.
+
+    Shows what applying ``src_dir`` to an instance exported as ``base_dir``
+    would change.
+    '''
+    result = diff_unpacked_schema(
+        load_dir(os.path.join(base_dir, 'schema'), as_dict=True),
+        load_dir(os.path.join(src_dir, 'schema'), as_dict=True))
+    if not pretty_print_schema_diff(result or {}):
+        log.info("Schema      :: \033[92mup to date!\033[0m")
+    return result
 
 
 QUESTIONS = [
@@ -295,7 +909,10 @@ def wipe(email, password, url=URL):
 DROP_FIELDS = ['user_created', 'user_updated']
 
 def data(*collections, email=EMAIL, password=PASSWORD, url=URL, out_dir=os.path.join(EXPORT_DIR, 'data'), drop_fields=DROP_FIELDS, only=None, force: 'bool'=False):
-    """Export Directus collection items to disk (for git-tracked data migrations)."""
+    """Export Directus collection items to disk (for git-tracked data migrations).
+
+    ``--only 'sensor_*'`` exports just the collections matching the globs.
+    """
     import tqdm
 
     assert url and email and password, "missing url and/or credentials"
@@ -308,6 +925,7 @@ def data(*collections, email=EMAIL, password=PASSWORD, url=URL, out_dir=os.path.
     if not collections:
         collections = [d['collection'] for d in api.get_collections()['data'] if d.get('meta')]
         collections = [c for c in collections if not c.startswith('directus_')]
+    collections = [c for c in collections if Scope(only).matches(c)]
 
     os.makedirs(out_dir, exist_ok=True)
     for c in collections:
@@ -326,8 +944,11 @@ def data(*collections, email=EMAIL, password=PASSWORD, url=URL, out_dir=os.path.
         dump_data(items, fname)
 
 
-def seed(email=EMAIL, password=PASSWORD, url=URL, out_dir=os.path.join(EXPORT_DIR, 'data'), only=None, force: 'bool'=False):
-    """Import Directus data from disk, ordered by foreign-key dependencies."""
+def seed(email=EMAIL, password=PASSWORD, url=URL, out_dir=os.path.join(EXPORT_DIR, 'data'), only=None, force: 'bool'=False, concurrency: 'int'=CONCURRENCY):
+    """Import Directus data from disk, ordered by foreign-key dependencies.
+
+    ``--only 'sensor_*'`` imports just the collections matching the globs.
+    """
 
     def get_schema_topo(fields):
         fields = [f for f in fields if f.get('schema')]
@@ -382,13 +1003,14 @@ def seed(email=EMAIL, password=PASSWORD, url=URL, out_dir=os.path.join(EXPORT_DI
     log.info(f"Importing Directus data to {url}")
     log.info(f"Loading from {out_dir}\n")
 
-    api = API(url)
+    api = API(url, concurrency=concurrency)
     api.login(email, password)
 
     # get collection topology
     data = {
         os.path.splitext(os.path.basename(f))[0]: load_data(f)
         for f in glob.glob(os.path.join(out_dir, '*'))
+        if Scope(only).matches(os.path.splitext(os.path.basename(f))[0])
     }
     collection_topo = {
         c: get_schema_topo(api.json('get', f'/fields/{c}')['data'])
@@ -400,15 +1022,18 @@ def seed(email=EMAIL, password=PASSWORD, url=URL, out_dir=os.path.join(EXPORT_DI
     keys = min_topological_sort(graph, flat=False)
 
     for group in keys:
-        for gkey in group:
+        rows = {}
+        for gkey in sorted(group, key=str):
             collection, key = gkey
             if not key or gkey not in graph_data:
                 log.info("Skipping %s", gkey)
                 continue
-            try:
-                log.info('creating %s: %s', gkey, api.create_items(collection, graph_data[gkey]))
-            except requests.exceptions.HTTPError as e:
-                log.info('updated %s: %s', gkey, api.update_item(collection, key, graph_data[gkey]))
+            rows.setdefault(collection, []).append(graph_data[gkey])
+        # rows in a group don't depend on each other, so they can be sent in
+        # bulk; rows that already exist get updated
+        for collection, items in rows.items():
+            created, updated = api.upsert_items(collection, items, key=collection_topo[collection][0])
+            log.info('%s: created %d, updated %d', collection, len(created), len(updated))
 
 
 def main():
@@ -417,10 +1042,12 @@ def main():
     fire.Fire({
         "diff": diff,
         "apply": apply,
+        "serve": serve,
         "export": export,
         "wipe": wipe,
         "data": data,
         "seed": seed,
+        "schema_diff": diff_schema_dirs,
         # "api": API,
     })
 
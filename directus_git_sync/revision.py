@@ -0,0 +1,63 @@
+import glob
+import logging
+import subprocess
+log = logging.getLogger(__name__.split('.')[0])
+
+# schema files that are not one collection, so a change to them needs the whole schema
+SCHEMA_WIDE = {'__meta__', '__unknown_collection__'}
+
+
+def _git(src_dir, *args):
+    return subprocess.run(
+        ['git', *args], cwd=src_dir, capture_output=True, text=True, check=True).stdout
+
+
+def head_commit(src_dir):
+    """The commit checked out in ``src_dir``, or None outside a git work tree."""
+    try:
+        return _git(src_dir, 'rev-parse', 'HEAD').strip() or None
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def changed_paths(src_dir, since):
+    """Paths under ``src_dir`` that differ from commit ``since``.
+
+    Compares the working tree, so uncommitted and untracked files count too.
+    Returns None when the comparison is impossible, e.g. ``since`` was
+    garbage collected or the history was rewritten.
+    """
+    try:
+        changed = _git(src_dir, 'diff', '--name-only', '--relative', since, '--')
+        untracked = _git(src_dir, 'ls-files', '--others', '--exclude-standard')
+    except (OSError, subprocess.CalledProcessError) as e:
+        log.warning('Cannot diff %s against %s: %s', src_dir, since, getattr(e, 'stderr', None) or e)
+        return None
+    return {path for path in (changed + untracked).splitlines() if path}
+
+
+def changed_scope(paths, types):
+    """The ``--only`` tokens covering ``paths``: resource types and collections.
+
+    ``settings.yaml`` and the top-level directories named in ``types`` map to
+    themselves, and ``schema/<collection>.yaml`` to its collection. Anything
+    else in the repository is not synced and is ignored.
+    """
+    tokens, collections, whole_schema = set(), set(), False
+    for path in paths:
+        top, _, rest = path.partition('/')
+        if path == 'settings.yaml':
+            tokens.add('settings')
+        elif top == 'schema' and rest:
+            name = rest.rsplit('.', 1)[0]
+            if name in SCHEMA_WIDE or '/' in name:
+                whole_schema = True
+            else:
+                collections.add(glob.escape(name))
+        elif top in types and top != 'schema' and rest:
+            tokens.add(top)
+    if whole_schema:
+        tokens.add('schema')
+    else:
+        tokens |= collections
+    return sorted(tokens)
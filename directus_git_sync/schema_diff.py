@@ -0,0 +1,156 @@
+'''Compute Directus schema diffs locally.
+
+Produces the same structure as ``POST /schema/diff`` (minus the ``hash``),
+so ``pretty_print_schema_diff`` and the plan can consume either. Entries use
+the deep-diff format Directus uses: ``N`` (new), ``D`` (deleted), ``E``
+(edited) and ``A`` (array change, wrapping one of the others in ``item``).
+``lhs`` is always the current side and ``rhs`` the desired one.
+'''
+import copy
+from .util import pack_schema
+
+
+def deep_diff(lhs, rhs, path=None):
+    """List the deep-diff entries that turn ``lhs`` into ``rhs``."""
+    path = path or []
+    if isinstance(lhs, dict) and isinstance(rhs, dict):
+        changes = []
+        for key in lhs:
+            if key not in rhs:
+                changes.append({'kind': 'D', 'path': path + [key], 'lhs': lhs[key]})
+            else:
+                changes.extend(deep_diff(lhs[key], rhs[key], path + [key]))
+        for key in rhs:
+            if key not in lhs:
+                changes.append({'kind': 'N', 'path': path + [key], 'rhs': rhs[key]})
+        return changes
+    if isinstance(lhs, list) and isinstance(rhs, list):
+        changes = []
+        # like deep-diff, removals from the end are listed last-first
+        for i in range(len(lhs) - 1, len(rhs) - 1, -1):
+            changes.append({'kind': 'A', 'path': path, 'index': i, 'item': {'kind': 'D', 'lhs': lhs[i]}})
+        for i in range(len(rhs) - 1, len(lhs) - 1, -1):
+            changes.append({'kind': 'A', 'path': path, 'index': i, 'item': {'kind': 'N', 'rhs': rhs[i]}})
+        for i in range(min(len(lhs), len(rhs))):
+            changes.extend(deep_diff(lhs[i], rhs[i], path + [i]))
+        return changes
+    if type(lhs) is not type(rhs) or lhs != rhs:
+        return [{'kind': 'E', 'path': path, 'lhs': lhs, 'rhs': rhs}]
+    return []
+
+
+def _diff_items(current, desired, keys, labels=()):
+    current = {tuple(item.get(k) for k in keys): item for item in current}
+    desired = {tuple(item.get(k) for k in keys): item for item in desired}
+    result = []
+    for key in sorted(set(current) | set(desired), key=lambda key: [str(k) for k in key]):
+        if key not in current:
+            diff = [{'kind': 'N', 'rhs': desired[key]}]
+        elif key not in desired:
+            diff = [{'kind': 'D', 'lhs': current[key]}]
+        else:
+            diff = deep_diff(current[key], desired[key])
+        if diff:
+            item = current.get(key) or desired[key]
+            result.append({**{k: item.get(k) for k in (*keys, *labels)}, 'diff': diff})
+    return result
+
+
+def diff_schema(current, desired):
+    """Diff two packed schema snapshots, e.g. ``API.export_schema()`` output.
+
+    Like the server, returns None when there is nothing to change.
+    """
+    result = {
+        'hash': None,
+        'diff': {
+            'collections': _diff_items(current.get('collections') or [], desired.get('collections') or [], ['collection']),
+            'fields': _diff_items(current.get('fields') or [], desired.get('fields') or [], ['collection', 'field']),
+            'relations': _diff_items(
+                current.get('relations') or [], desired.get('relations') or [],
+                ['collection', 'field'], labels=['related_collection']),
+        },
+    }
+    return result if any(result['diff'].values()) else None
+
+
+def diff_unpacked_schema(current, desired):
+    """Diff two schemas in the per-collection layout written by ``export``."""
+    # pack_schema writes sort/group back into the nested items
+    return diff_schema(pack_schema(copy.deepcopy(current)), pack_schema(copy.deepcopy(desired)))
+
+
+def _whole(entry, kind):
+    """Whether a diff entry creates (N) or deletes (D) its whole item."""
+    return any(d.get('kind') == kind and not d.get('path') for d in entry.get('diff') or [])
+
+
+def split_schema_diff(diff, size):
+    """Split a schema diff into dependency-ordered chunks of ``size`` units.
+
+    A unit is a relation, or a collection's changes. A new collection travels
+    with its fields, since Directus creates them together. Relation removals
+    come first. Collections come before their fields, and fields before
+    relations. Field removals and then collection removals come last.
+    """
+    collections = diff.get('collections') or []
+    fields = diff.get('fields') or []
+    relations = diff.get('relations') or []
+    created = {c['collection']: c for c in collections if _whole(c, 'N')}
+    dropped = {c['collection'] for c in collections if _whole(c, 'D')}
+
+    def depth(name, seen=()):
+        # new collections inside new groups wait for the group
+        group = ((created[name]['diff'][0].get('rhs') or {}).get('meta') or {}).get('group')
+        return 0 if group not in created or group in seen else 1 + depth(group, (*seen, name))
+
+    def of(name, entries, keep=lambda f: True):
+        return [f for f in entries if f['collection'] == name and keep(f)]
+
+    units = [(0, 0, {'relations': [r]}) for r in relations if _whole(r, 'D')]
+    for c in collections:
+        name = c['collection']
+        if name in created:
+            units.append((1, depth(name), {'collections': [c], 'fields': of(name, fields)}))
+        elif name not in dropped:
+            units.append((1, 0, {'collections': [c]}))
+    for name in sorted({f['collection'] for f in fields} - set(created) - dropped):
+        changed = of(name, fields, lambda f: not _whole(f, 'D'))
+        removed = of(name, fields, lambda f: _whole(f, 'D'))
+        if changed:
+            units.append((2, 0, {'fields': changed}))
+        if removed:
+            units.append((4, 0, {'fields': removed}))
+    units += [(3, 0, {'relations': [r]}) for r in relations if not _whole(r, 'D')]
+    for c in collections:
+        if c['collection'] in dropped:
+            units.append((5, 0, {'collections': [c], 'fields': of(c['collection'], fields)}))
+
+    units = [unit for *_, unit in sorted(units, key=lambda u: u[:2])]
+    chunks = []
+    for i in range(0, len(units), max(1, size)):
+        chunk = {'collections': [], 'fields': [], 'relations': []}
+        for unit in units[i:i + max(1, size)]:
+            for key, entries in unit.items():
+                chunk[key].extend(entries)
+        chunks.append(chunk)
+    return chunks
+
+
+def filter_schema(schema, keep):
+    """A packed schema limited to the collections ``keep(name)`` accepts."""
+    return {
+        **schema,
+        **{
+            key: [item for item in schema.get(key) or [] if keep(item.get('collection'))]
+            for key in ('collections', 'fields', 'relations')
+        },
+    }
+
+
+def filter_schema_diff(diff, keep):
+    """A schema diff limited to the collections ``keep(name)`` accepts, or None if empty."""
+    if not diff:
+        return None
+    diff = {**diff, 'diff': filter_schema(diff.get('diff') or {}, keep)}
+    return diff if any(diff['diff'].values()) else None
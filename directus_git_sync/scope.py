@@ -0,0 +1,37 @@
+import fnmatch
+
+
+class Scope:
+    '''The part of an instance a command works on, parsed from ``--only``.
+
+    ``--only`` takes a comma-separated list of resource types (e.g.
+    ``flows,operations``, ``settings``, ``schema``) and collection globs
+    (e.g. ``sensor_*``). Globs limit the schema and data to the matching
+    collections and bring the schema into scope. Without ``--only``
+    everything is in scope.
+    '''
+    def __init__(self, only=None, types=()):
+        if isinstance(only, str):
+            only = only.split(',')
+        tokens = [str(token).strip() for token in only or () if str(token).strip()]
+        self.only = ','.join(tokens) or None
+        self.types = {token for token in tokens if token in types}
+        self.globs = [token for token in tokens if token not in types]
+        if self.globs:
+            self.types.add('schema')
+        self.everything = not tokens
+
+    def __contains__(self, name):
+        return self.everything or name in self.types
+
+    def __repr__(self):
+        return f'Scope({self.only!r})'
+
+    def matches(self, collection):
+        """Whether a collection is in scope."""
+        return not self.globs or any(fnmatch.fnmatchcase(collection or '', glob) for glob in self.globs)
+
+    @property
+    def collections(self):
+        """A collection predicate for the schema functions, or None for all."""
+        return self.matches if self.globs else None
@@ -0,0 +1,105 @@
+'''Triggers for the ``serve`` daemon.
+
+Each trigger calls ``Trigger.fire``. The daemon's loop waits in
+``Trigger.wait`` and reconciles once a burst of triggers has settled, so a
+git checkout that rewrites fifty files costs one reconcile.
+'''
+import json
+import time
+import signal
+import logging
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from .util import tree_signature
+log = logging.getLogger(__name__.split('.')[0])
+
+
+class Trigger:
+    '''Requests for a reconcile, merged until they stop arriving for ``debounce`` seconds.'''
+    def __init__(self, debounce=5):
+        self.debounce = debounce
+        self._cond = threading.Condition()
+        self._last = None
+        self._reasons = set()
+
+    def fire(self, reason):
+        with self._cond:
+            self._last = time.monotonic()
+            self._reasons.add(reason)
+            self._cond.notify_all()
+
+    def wait(self, timeout=None):
+        """Wait for a settled burst and return its reasons, or an empty set after ``timeout``."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if self._last is not None:
+                    settled = self._last + self.debounce - now
+                    if settled <= 0:
+                        reasons, self._reasons, self._last = self._reasons, set(), None
+                        return reasons
+                    self._cond.wait(settled)
+                elif deadline is not None and now >= deadline:
+                    return set()
+                else:
+                    self._cond.wait(None if deadline is None else deadline - now)
+
+
+def _thread(target, *args):
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    return thread
+
+
+def watch_files(path, trigger, interval=2, stop=None):
+    """Fire ``trigger`` whenever the tree at ``path`` changes, polling every ``interval`` seconds.
+
+    Polling file stats needs no extra dependency and also notices git-sync
+    swapping the symlink of its worktree.
+    """
+    stop = stop or threading.Event()
+
+    def run():
+        signature = tree_signature(path)
+        while not stop.wait(interval):
+            current = tree_signature(path)
+            if current != signature:
+                signature = current
+                trigger.fire('files')
+    return _thread(run)
+
+
+def watch_signal(trigger, signum=signal.SIGHUP):
+    """Fire ``trigger`` on a signal, e.g. ``kill -HUP``. Call from the main thread."""
+    signal.signal(signum, lambda *_: trigger.fire('signal'))
+
+
+def serve_http(trigger, status, host='127.0.0.1', port=8056):
+    """Fire ``trigger`` on ``POST /reconcile``. ``GET /status`` returns ``status()`` as JSON."""
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, code, body):
+            content = json.dumps(body, default=str).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_POST(self):
+            if self.path.rstrip('/') != '/reconcile':
+                return self._reply(404, {'error': 'not found'})
+            trigger.fire('http')
+            self._reply(202, {'queued': True})
+
+        def do_GET(self):
+            if self.path.rstrip('/') != '/status':
+                return self._reply(404, {'error': 'not found'})
+            self._reply(200, status())
+
+        def log_message(self, format, *args):
+            log.debug('http: ' + format, *args)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    _thread(server.serve_forever)
+    return server
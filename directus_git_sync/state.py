@@ -0,0 +1,58 @@
+import os
+import json
+import hashlib
+import threading
+import contextlib
+try:
+    import fcntl
+except ImportError:  # not on Windows
+    fcntl = None
+
+
+class State:
+    '''Facts remembered between runs against one Directus instance.
+
+    A small JSON document per instance URL in ``path``. Writes go to a
+    temporary file first, so an interrupted run never leaves it half written.
+    '''
+    def __init__(self, path, url):
+        os.makedirs(path, exist_ok=True)
+        self.file = os.path.join(path, hashlib.sha1(url.encode()).hexdigest()[:16] + '.json')
+        self._lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.file) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def get(self, key, default=None):
+        return self.load().get(key, default)
+
+    def update(self, **values):
+        """Set keys, removing those given as None."""
+        with self._lock:
+            data = self.load()
+            for key, value in values.items():
+                if value is None:
+                    data.pop(key, None)
+                else:
+                    data[key] = value
+            tmp = f'{self.file}.{threading.get_ident()}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(data, f, indent=2, sort_keys=True)
+            os.replace(tmp, self.file)
+
+    @contextlib.contextmanager
+    def lock(self):
+        """Hold an exclusive lock on the instance, shared by every process using ``path``."""
+        if fcntl is None:
+            yield self
+            return
+        with open(f'{self.file}.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield self
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
@@ -0,0 +1,31 @@
+import os
+import json
+import hashlib
+import threading
+
+
+class TokenCache:
+    '''The access and refresh tokens of one user on one instance, kept between runs.
+
+    One JSON file per URL and email in ``path``. Only its owner can read or
+    write it (mode 0600, in a 0700 directory when it is created here).
+    '''
+    def __init__(self, path, url, email):
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        key = hashlib.sha1(f'{url}\0{email}'.encode()).hexdigest()[:16]
+        self.file = os.path.join(path, f'token-{key}.json')
+
+    def load(self):
+        try:
+            with open(self.file) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def store(self, tokens):
+        tmp = f'{self.file}.{os.getpid()}.{threading.get_ident()}.tmp'
+        # created private, so the tokens are never readable by others, not even briefly
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(tokens, f)
+        os.replace(tmp, self.file)
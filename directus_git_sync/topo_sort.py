@@ -1,5 +1,6 @@
 
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 def dict_dependencies(data, keys, ignore=[]):
     '''Recurse through a dictionary finding all references to values within keys.'''
@@ -67,6 +68,29 @@ def min_topological_sort(graph, flat=True):
         sets = [x for xs in sets for x in xs]
     return sets
 
+def run_topological(graph, fn, max_workers=1):
+    '''Call ``fn(node)`` for each node once all of the nodes it depends on have finished.
+    Independent branches run concurrently on up to ``max_workers`` threads. After a
+    failure no new nodes are started and the error is raised once running calls finish.
+    '''
+    remaining = clean_graph({node: set(deps) for node, deps in graph.items()})
+    min_topological_sort(remaining)  # fail early on cycles
+    done, results, running = set(), {}, {}
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        def submit_ready():
+            for node in [n for n, deps in remaining.items() if deps <= done]:
+                del remaining[node]
+                running[pool.submit(fn, node)] = node
+        submit_ready()
+        while running:
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                node = running.pop(future)
+                results[node] = future.result()
+                done.add(node)
+            submit_ready()
+    return results
+
 def create_graph_from_items(items, id_key='id'):
     '''Create a graph dictionary from a dict of items.'''
     if not isinstance(items, dict):
@@ -3,8 +3,10 @@
 import os
 import re
 import csv
+import copy
 import glob
 import json
+import hashlib
 import yaml
 # try:
 #     from yaml import CLoader as Loader, CDumper as Dumper
@@ -44,7 +46,7 @@ def _export_key(data, keys):
     return k
 
 
-def export_dir(data, out_dir, name=None, keys=['name', 'id'], ext='yaml'):
+def export_dir(data, out_dir, name=None, keys=['name', 'id'], ext='yaml', prune=True):
     counts = {'unchanged': 0, 'modified': 0, 'renamed': 0, 'new': 0, 'deleted': 0}
     if name is None:
         name = out_dir.rsplit(os.sep, 1)[-1]
@@ -80,7 +82,7 @@ def export_dir(data, out_dir, name=None, keys=['name', 'id'], ext='yaml'):
         state = _export_one(d, out_dir, k, ext)
         counts[state] += 1
 
-    for name_i in existing - set(data):
+    for name_i in (existing - set(data)) if prune else ():
         log.warning("%s :: Removing %s", name, name_i)
         os.remove(get_fname(out_dir, name_i, ext))
         counts['deleted'] += 1
@@ -98,12 +100,13 @@ def export_dir(data, out_dir, name=None, keys=['name', 'id'], ext='yaml'):
 
 
 
-def load_dir(src_dir, as_dict=False):
+def load_dir(src_dir, as_dict=False, cached=False):
+    load = load_data_cached if cached else load_data
     if os.path.isfile(src_dir):
-        return load_data(src_dir)
+        return load(src_dir)
     if as_dict:
-        return {os.path.splitext(os.path.basename(f))[0]: load_data(f) for f in glob.glob(f'{src_dir}/*')}
-    return [load_data(f) for f in glob.glob(f'{src_dir}/*')]
+        return {os.path.splitext(os.path.basename(f))[0]: load(f) for f in glob.glob(f'{src_dir}/*')}
+    return [load(f) for f in glob.glob(f'{src_dir}/*')]
 
 # def load_dir(src_dir):
 #     if os.path.isfile(src_dir):
@@ -219,6 +222,46 @@ def load_data(file_path):
         raise ValueError("Unsupported file format. Supported formats: csv, json, yaml/yml")
 
 
+# parsed yaml/json documents by content hash, see ``load_data_cached``
+_PARSED = {}
+PARSED_CACHE_SIZE = 20000
+
+
+def load_data_cached(file_path):
+    """``load_data`` that parses each distinct yaml/json content only once.
+
+    Keyed by a hash of the bytes rather than the mtime, so that parses also
+    survive checkouts that rewrite every file, like git-sync's worktrees.
+    Returns a copy, so callers may modify the result.
+    """
+    parse = {'yaml': yaml.safe_load, 'yml': yaml.safe_load, 'json': json.loads}.get(file_path.split('.')[-1].lower())
+    if parse is None:
+        return load_data(file_path)
+    with open(file_path, 'rb') as f:
+        content = f.read()
+    key = hashlib.sha1(content).hexdigest()
+    if key not in _PARSED:
+        if len(_PARSED) >= PARSED_CACHE_SIZE:
+            _PARSED.clear()
+        _PARSED[key] = parse(content)
+    return copy.deepcopy(_PARSED[key])
+
+
+def tree_signature(path):
+    """A cheap fingerprint of a directory tree: where it resolves to, and its file stats."""
+    root = os.path.realpath(path)
+    stats = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if d != '.git')
+        for name in sorted(filenames):
+            try:
+                stat = os.stat(os.path.join(dirpath, name))
+            except FileNotFoundError:
+                continue
+            stats.append((os.path.relpath(os.path.join(dirpath, name), root), stat.st_mtime_ns, stat.st_size))
+    return hashlib.sha1(json.dumps([root, stats]).encode()).hexdigest()
+
+
 
 def dict_diff(d1, d2):
     missing1 = d2.keys() - d1
@@ -227,6 +270,17 @@ def dict_diff(d1, d2):
     return missing1, missing2, mismatch
 
 
+def item_digest(item, ignore=()):
+    """A stable digest of an item's content.
+
+    Keys are serialized in sorted order at every level, so key order never
+    changes the digest, and ``ignore`` keys are left out entirely.
+    """
+    if ignore:
+        item = {k: v for k, v in item.items() if k not in ignore}
+    return hashlib.sha1(json.dumps(item, sort_keys=True, separators=(',', ':'), default=str).encode()).hexdigest()
+
+
 def get_key(d, *keys, default=None):
     try:
         for k in keys:
@@ -5,7 +5,7 @@ import pytest
 import yaml
 
 from directus_git_sync.api import API
-from directus_git_sync.commands import _load_configuration, build_plan
+from directus_git_sync.commands import RESOURCE_CONFIG, _load_configuration, _managed_query, build_plan
 from directus_git_sync.util import export_dir
 
 
@@ -35,7 +35,7 @@ def snapshot(tmp_path, with_policy=True):
 class FakeAPI(API):
     def __init__(self):
         pass
-    def diff_unpacked_schema(self, schema, force=False):
+    def diff_unpacked_schema(self, schema, force=False, collections=None):
         return None
 
     def export_settings(self):
@@ -44,7 +44,7 @@ class FakeAPI(API):
     def export_extensions(self):
         return []
 
-    def json(self, method, route):
+    def json(self, method, route, **kw):
         values = {
             '/policies': [{'id': 'admin', 'admin_access': True}, {
                 'id': 'p1', 'name': 'Engineer', 'admin_access': False,
@@ -60,6 +60,10 @@ class FakeAPI(API):
             ],
             '/flows': [], '/operations': [], '/dashboards': [], '/panels': [],
             '/presets': [{'id': 99, 'user': 'u1'}], '/webhooks': [],
+            '/fields': [
+                {'collection': 'directus_roles', 'field': field}
+                for field in ('id', 'name', 'policies', 'children', 'users', 'user_created')
+            ],
         }
         return {'data': values[route]}
 
@@ -114,12 +118,12 @@ def test_build_plan_covers_managed_resources_without_deleting_system_state(tmp_p
 def test_empty_directus_schema_diff_is_not_a_change(tmp_path):
     snapshot(tmp_path)
     api = FakeAPI()
-    api.diff_unpacked_schema = lambda schema, force=False: {
+    api.diff_unpacked_schema = lambda schema, force=False, collections=None: {
         'hash': 'unchanged',
         'diff': {'collections': [], 'fields': [], 'relations': []},
     }
     api.export_settings = lambda: {'id': 2, 'project_name': 'FloodNet'}
-    api.json = lambda method, route: {'data': {
+    api.json = lambda method, route, **kw: {'data': {
         '/policies': [{'id': 'p1', 'name': 'Engineer', 'admin_access': False,
                        'app_access': True, 'roles': [], 'users': []}],
         '/roles': [{'id': 'r1', 'name': 'Engineer', 'policies': ['p1'],
@@ -128,6 +132,357 @@ def test_empty_directus_schema_diff_is_not_a_change(tmp_path):
                           'collection': 'sensors'}],
         '/flows': [], '/operations': [], '/dashboards': [], '/panels': [],
         '/presets': [], '/webhooks': [],
-    }[route]}
+    }.get(route, [])}
 
     assert build_plan(api, tmp_path)['has_changes'] is False
+
+
+def test_export_fetches_concurrently_and_filters_by_policies(tmp_path, monkeypatch):
+    import threading
+    from directus_git_sync import commands
+
+    released = threading.Event()
+
+    class ExportAPI:
+        transport = 'rest'
+        def __init__(self, url, **kw):
+            pass
+        def login(self, email, password):
+            return self
+        def projection(self, route, exclude=None, keep=()):
+            return {}
+        def export_policies(self, **params):
+            # every other resource must be able to finish before policies arrive
+            assert released.wait(5)
+            return [{'id': 'p1', 'name': 'Engineer', 'admin_access': False, 'users': ['u1']}]
+        def export_roles(self, **params):
+            return [{'id': 'r1', 'name': 'Engineer', 'policies': ['p1'], 'users': ['u1']},
+                    {'id': 'r2', 'name': 'Admin', 'policies': ['admin']}]
+        def export_permissions(self, **params):
+            return [{'id': 1, 'policy': 'p1', 'action': 'read', 'collection': 'sensors'},
+                    {'id': 2, 'policy': 'admin', 'action': 'read', 'collection': 'sensors'}]
+        def export_presets(self, **params):
+            released.set()
+            return [{'id': 9, 'user': 'u1', 'collection': 'sensors'}]
+        def export_settings(self):
+            return {'id': 1, 'project_name': 'FloodNet'}
+        def export_unpacked_schema(self):
+            return {'__meta__': {'sort': []}}
+        def export_extensions(self):
+            return []
+        export_flows = export_operations = export_dashboards = export_extensions
+        export_panels = export_webhooks = export_extensions
+
+    monkeypatch.setattr(commands, 'API', ExportAPI)
+    commands.export('a@b.c', 'pw', 'http://example.invalid', out_dir=str(tmp_path), workers=4)
+
+    assert yaml.safe_load((tmp_path / 'settings.yaml').read_text()) == {'project_name': 'FloodNet'}
+    assert [p.name for p in (tmp_path / 'roles').iterdir()] == ['Engineer-r1.yaml']
+    assert 'users' not in yaml.safe_load((tmp_path / 'roles' / 'Engineer-r1.yaml').read_text())
+    assert [p.name for p in (tmp_path / 'permissions').iterdir()] == ['p1-read-sensors-1.yaml']
+    assert list((tmp_path / 'presets').iterdir()) == []
+
+
+def test_build_plan_collects_remote_state_concurrently(tmp_path):
+    import threading
+
+    snapshot(tmp_path)
+    barrier = threading.Barrier(3, timeout=5)
+
+    class ConcurrentAPI(FakeAPI):
+        def diff_unpacked_schema(self, schema, force=False, collections=None):
+            barrier.wait()
+            return None
+        def export_settings(self):
+            barrier.wait()
+            return super().export_settings()
+        def export_extensions(self):
+            barrier.wait()
+            return []
+
+    assert build_plan(ConcurrentAPI(), tmp_path, workers=4)['has_changes'] is True
+
+
+def test_scoped_plan_reads_only_what_is_in_scope(tmp_path):
+    from directus_git_sync.scope import Scope
+    from directus_git_sync.commands import SCOPE_TYPES
+
+    scope = Scope('flows, sensor_*', SCOPE_TYPES)
+    assert 'flows' in scope and 'schema' in scope and 'roles' not in scope
+    assert scope.matches('sensor_readings') and not scope.matches('deployments')
+
+    snapshot(tmp_path)
+    (tmp_path / 'settings.yaml').unlink()
+
+    class RecordingAPI(FakeAPI):
+        routes = []
+        def json(self, method, route, **kw):
+            self.routes.append(route)
+            return super().json(method, route, **kw)
+        def export_settings(self):
+            raise AssertionError('settings are out of scope')
+        def export_extensions(self):
+            raise AssertionError('extensions are out of scope')
+
+    api = RecordingAPI()
+    plan = build_plan(api, tmp_path, only='flows')
+    assert set(plan['resources']) == {'flows'} and plan['only'] == 'flows'
+    assert plan['has_changes'] is False and plan['schema'] is None
+    assert [route for route in api.routes if not route.startswith('/fields')] == ['/flows']
+
+
+def test_saved_plan_runs_planned_operations_and_rejects_stale_state(tmp_path):
+    from directus_git_sync.commands import _apply_saved_plan
+
+    snapshot(tmp_path)
+    plan = json.loads(json.dumps(build_plan(FakeAPI(), tmp_path, payloads=True)))
+    assert plan['payloads']['roles']['update'][0]['name'] == 'Engineer'
+
+    class RecordingAPI(FakeAPI):
+        calls = []
+        def json(self, method, route, **kw):
+            if method == 'GET':
+                return super().json(method, route)
+            self.calls.append((method, route, kw.get('json')))
+            return {'data': {}}
+
+    api = RecordingAPI()
+    _apply_saved_plan(api, plan, workers=2)
+    assert sorted(call[:2] for call in api.calls) == [('PATCH', '/roles/r1'), ('PATCH', '/settings')]
+    patch = dict((route, body) for _, route, body in api.calls)['/roles/r1']
+    assert patch['name'] == 'Engineer' and 'users' not in patch
+
+    api.export_settings = lambda: {'id': 2, 'project_name': 'Edited in the UI'}
+    with pytest.raises(ValueError, match=r'changed since the plan.*settings/settings'):
+        _apply_saved_plan(api, plan)
+
+
+def test_diff_output_saves_payloads_but_prints_a_summary(tmp_path, monkeypatch, capsys):
+    from directus_git_sync import commands
+
+    class DiffAPI(FakeAPI):
+        def __init__(self, *args, **kw):
+            pass
+        def login(self, *args):
+            return self
+
+    snapshot(tmp_path / 'src')
+    monkeypatch.setattr(commands, 'API', DiffAPI)
+    commands.diff(src_dir=tmp_path / 'src', output=tmp_path / 'plan.json')
+    printed = json.loads(capsys.readouterr().out)
+    saved = json.loads((tmp_path / 'plan.json').read_text())
+    assert {'payloads', 'digests'} <= set(saved) and not {'payloads', 'digests'} & set(printed)
+    assert printed['resources'] == saved['resources']
+
+
+def test_saved_plan_never_deletes_a_role_assigned_since_the_plan(tmp_path):
+    from directus_git_sync.commands import _apply_saved_plan
+
+    snapshot(tmp_path)
+
+    class RolesAPI(FakeAPI):
+        users = []
+        calls = []
+        def json(self, method, route, **kw):
+            if method != 'GET':
+                self.calls.append((method, route, kw.get('json')))
+                return {'data': {}}
+            data = super().json(method, route)
+            if route == '/roles':
+                data['data'].append({
+                    'id': 'r9', 'name': 'Temp', 'policies': ['p1'],
+                    'admin_access': False, 'users': self.users,
+                })
+            return data
+
+    plan = json.loads(json.dumps(build_plan(RolesAPI(), tmp_path, payloads=True)))
+    assert plan['payloads']['roles']['delete'][0]['id'] == 'r9'
+
+    # a user got the role after the plan; bindings are not in the fingerprint
+    api = RolesAPI()
+    api.users = ['u2']
+    _apply_saved_plan(api, plan, workers=2)
+    assert ('DELETE', '/roles', ['r9']) not in api.calls
+
+    api = RolesAPI()
+    _apply_saved_plan(api, plan, workers=2)
+    assert ('DELETE', '/roles', ['r9']) in api.calls
+
+
+def test_saved_plan_is_verified_against_itself_without_the_snapshot(tmp_path):
+    from directus_git_sync.commands import _reconcile
+
+    snapshot(tmp_path / 'src')
+    plan_file = tmp_path / 'plan.json'
+    plan_file.write_text(json.dumps(build_plan(FakeAPI(), tmp_path / 'src', payloads=True), default=str))
+
+    class StatefulAPI(FakeAPI):
+        identity = 'admin@example.com'
+        def __init__(self, applies=True):
+            self.applies, self.settings, self.roles = applies, {'id': 2, 'project_name': 'Old'}, {}
+        def export_settings(self):
+            return dict(self.settings)
+        def json(self, method, route, **kw):
+            if method == 'GET':
+                data = super().json(method, route)
+                if route == '/roles':
+                    data = {'data': [{**item, **self.roles.get(item['id'], {})} for item in data['data']]}
+                return data
+            if self.applies and route == '/settings':
+                self.settings.update(kw['json'])
+            elif self.applies:
+                self.roles[route.rsplit('/', 1)[-1]] = kw['json']
+            return {'data': {}}
+
+    # the snapshot the plan was made from is gone
+    missing = tmp_path / 'missing'
+    for verify in ('touched', 'full'):
+        result = _reconcile(StatefulAPI(), None, None, missing, plan=str(plan_file), verify=verify)
+        assert result['verify'] == verify
+    with pytest.raises(RuntimeError, match='did not converge.*roles'):
+        _reconcile(StatefulAPI(applies=False), None, None, missing, plan=str(plan_file), verify='full')
+
+
+def test_verify_touched_rereads_only_mutated_ids(tmp_path):
+    from directus_git_sync.commands import _verify_touched
+
+    snapshot(tmp_path)
+    desired = _load_configuration(tmp_path)
+    reads = []
+
+    class VerifyAPI(FakeAPI):
+        def json(self, method, route, **kw):
+            reads.append((route, kw.get('params')))
+            return super().json(method, route)
+
+    problems = _verify_touched(VerifyAPI(), desired, {'/permissions': {'1'}, '/roles': {'r1'}})
+    assert [route for route, _ in reads] == ['/roles', '/permissions']
+    assert json.loads(reads[0][1]['filter']) == {'id': {'_in': ['r1']}}
+    # the fake server never received the role rename, so roles haven't converged
+    assert problems == {'roles': {'create': [], 'update': ['r1'], 'delete': []}}
+
+    # many ids are read in batches, not in one long query string
+    reads.clear()
+    api = VerifyAPI()
+    api.batch_size = 2
+    assert _verify_touched(api, desired, {'/permissions': {'1', '3', '4', '5', '6'}}) == {}
+    assert [json.loads(params['filter'])['id']['_in'] for _, params in reads] == [['1', '3'], ['4', '5'], ['6']]
+
+
+def test_managed_reads_are_filtered_and_projected_by_directus():
+    class RecordingAPI(FakeAPI):
+        routes, params = [], []
+        def json(self, method, route, **kw):
+            self.routes.append(route)
+            self.params.append(kw.get('params'))
+            return super().json(method, route, **kw)
+
+    api = RecordingAPI()
+    with api.cached():
+        # forbidden keys are left out, except the ones role protection depends on
+        assert _managed_query(api, 'roles', set()) == {'fields': 'id,name,policies,users'}
+        query = _managed_query(api, 'permissions', {'p2', 'p1'})
+        assert json.loads(query['filter']) == {'policy': {'_in': ['p1', 'p2']}}
+        assert json.loads(_managed_query(api, 'presets', set())['filter']) == {'user': {'_null': True}}
+    # every projection of a run comes from one /fields read of the system collections
+    assert api.routes == ['/fields']
+    assert json.loads(api.params[0]['filter']) == {'collection': {'_starts_with': 'directus_'}}
+    # and it is not kept beyond the run
+    _managed_query(api, 'roles', set())
+    assert api.routes == ['/fields', '/fields']
+
+
+def test_graphql_transport_plans_like_rest_in_one_query(tmp_path):
+    snapshot(tmp_path)
+    queries = []
+    columns = {
+        'settings': ['id', 'project_name'],
+        'policies': ['id', 'name', 'admin_access', 'app_access', 'roles', 'users'],
+        'roles': ['id', 'name', 'children', 'users', 'policies', 'divider'],
+        'permissions': ['id', 'policy', 'action', 'collection'],
+        'access': ['id', 'role', 'policy'],
+        'presets': ['id', 'user'],
+    }
+    types = {('roles', 'policies'): 'alias', ('roles', 'divider'): 'alias'}
+
+    class GraphQLAPI(FakeAPI):
+        transport = 'graphql'
+
+        def json(self, method, route, **kw):
+            if route == '/fields':
+                return {'data': [
+                    {'collection': f'directus_{name}', 'field': field,
+                     'type': types.get((name, field), 'string'),
+                     'schema': {'is_primary_key': field == 'id'}}
+                    for name, fields in columns.items() for field in fields
+                ]}
+            if route == '/relations':
+                return {'data': [
+                    {'collection': 'directus_permissions', 'field': 'policy',
+                     'related_collection': 'directus_policies'},
+                    {'collection': 'directus_access', 'field': 'role',
+                     'related_collection': 'directus_roles', 'meta': {'one_field': 'policies'}},
+                ]}
+            assert (method, route) == ('POST', '/graphql/system')
+            queries.append(kw['json']['query'])
+            data = {'settings': self.export_settings()}
+            for name in RESOURCE_CONFIG:
+                data[name] = super().json('GET', f'/{name}')['data']
+            for role in data['roles']:
+                role['policies'] = [{'id': key} for key in role['policies']]
+            for permission in data['permissions']:
+                permission['policy'] = {'id': permission['policy']}
+            return {'data': data}
+
+    assert build_plan(GraphQLAPI(), tmp_path) == build_plan(FakeAPI(), tmp_path)
+    [query] = queries
+    assert 'policies { id }' in query and 'policy { id }' in query
+    assert 'divider' not in query and 'children' not in query
+    assert 'permissions(limit: -1, filter: {policy: {id: {_in: ["p1"]}}})' in query
+    assert 'presets(limit: -1, filter: {user: {id: {_null: true}}})' in query
+
+
+def test_incremental_reconcile_scopes_by_git_and_activity(tmp_path):
+    import subprocess
+    from directus_git_sync.commands import _reconcile
+    from directus_git_sync.state import State
+
+    src = tmp_path / 'src'
+    snapshot(src)
+    dump(src / 'schema' / 'sensors.yaml', {'collection': 'sensors'})
+    subprocess.run(
+        'git init -q && git add . && git -c user.name=t -c user.email=t@t commit -qm init',
+        shell=True, cwd=src, check=True)
+
+    class IncrementalAPI(FakeAPI):
+        identity = 'admin@example.com'
+        def __init__(self):
+            self.state = State(str(tmp_path / 'state'), 'http://example.invalid')
+            self.edited, self.latest, self.schemas = set(), 10, []
+        def activity_since(self, watermark=None, collections=()):
+            return self.edited, self.latest
+        def diff_apply_unpacked_schema(self, schema, collections=None, **kw):
+            self.schemas.append(collections)
+        def apply_settings(self, settings, **kw):
+            pass
+        def json(self, method, route, **kw):
+            return super().json(method, route, **kw) if method == 'GET' else {'data': {}}
+
+    api = IncrementalAPI()
+    def run(interval=3600):
+        return _reconcile(api, None, None, src, verify='none', incremental=True, reconcile_interval=interval)
+
+    # no earlier run: everything, and the activity watermark is taken
+    run()
+    assert api.schemas == [None] and api.state.get('applied')['activity'] == 10
+    assert run()['only'] == []
+
+    # a collection changed in git is applied on its own
+    dump(src / 'schema' / 'sensors.yaml', {'collection': 'sensors', 'meta': {}})
+    run()
+    assert api.schemas[-1]('sensors') and not api.schemas[-1]('deployments')
+
+    # a schema edit in the UI brings the whole schema into scope
+    api.edited, api.latest = {'directus_fields'}, 12
+    run(interval=0)
+    assert api.schemas[-1] is None and api.state.get('applied')['activity'] == 12
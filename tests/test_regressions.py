@@ -1,10 +1,12 @@
+import json
+
 import requests
 
 import pytest
 
 from directus_git_sync.api import API
-from directus_git_sync.topo_sort import min_topological_sort
-from directus_git_sync.util import dump_data, load_data
+from directus_git_sync.topo_sort import min_topological_sort, invert_graph, run_topological
+from directus_git_sync.util import dump_data, load_data, item_digest
 
 
 def test_txt_round_trip(tmp_path):
@@ -24,6 +26,30 @@ def test_min_topological_sort_groups_parallel_nodes():
     assert min_topological_sort({'B': {'A'}, 'C': {'B'}}, flat=True) == ['A', 'B', 'C']
 
 
+def test_run_topological_runs_branches_concurrently_in_dependency_order():
+    import threading
+    from directus_git_sync.commands import resource_graph
+
+    graph = resource_graph()
+    barrier = threading.Barrier(4, timeout=5)
+    order = []
+
+    def visit(name):
+        if name in ('policies', 'flows', 'dashboards', 'webhooks'):
+            barrier.wait()  # every independent root is in flight at once
+        order.append(name)
+        return name
+
+    assert set(run_topological(graph, visit, max_workers=4)) == set(graph)
+    for name, deps in graph.items():
+        assert all(order.index(dep) < order.index(name) for dep in deps)
+
+    order.clear()
+    run_topological(invert_graph(graph), order.append, max_workers=4)
+    assert order.index('permissions') < order.index('policies')
+    assert order.index('presets') < order.index('roles') < order.index('policies')
+
+
 def test_json_merges_caller_headers(monkeypatch):
     captured = {}
 
@@ -38,15 +64,26 @@ def test_json_merges_caller_headers(monkeypatch):
         def json(self):
             return {}
 
-    def fake_request(method, url, **kw):
+    def fake_request(session, method, url, **kw):
         captured['headers'] = kw['headers']
+        captured['timeout'] = kw['timeout']
         return FakeResponse()
 
-    monkeypatch.setattr(requests, 'request', fake_request)
-    api = API('http://example.invalid')
+    monkeypatch.setattr(requests.Session, 'request', fake_request)
+    api = API('http://example.invalid', timeout=12)
     api.headers['Authorization'] = 'Bearer token'
     api.json('GET', '/x', headers={'X-Custom': '1'})
     assert captured['headers'] == {'Authorization': 'Bearer token', 'X-Custom': '1'}
+    assert captured['timeout'] == 12
+
+
+def test_session_pools_connections_and_retries_idempotent_methods():
+    api = API('http://example.invalid', pool_size=4, retries=2)
+    adapter = api.session.get_adapter('https://example.invalid')
+    assert adapter._pool_maxsize == 4
+    assert adapter.max_retries.total == 2
+    assert adapter.max_retries.is_retry('GET', 503)
+    assert not adapter.max_retries.is_retry('POST', 503)
 
 
 def test_iter_items_honors_limit():
@@ -73,6 +110,8 @@ def test_apply_does_not_mutate_input_and_ignores_user_updated():
     captured = {}
 
     def fake_json(method, route, **kw):
+        if route.startswith('/fields'):
+            return {'data': []}
         if method == 'GET' and route == '/roles':
             return {'data': [{
                 'id': 'r1', 'name': 'Old',
@@ -104,6 +143,8 @@ def test_apply_roles_preserves_administrator_and_assigned_roles():
     requests = []
 
     def fake_json(method, route, **kw):
+        if route.startswith('/fields'):
+            return {'data': []}
         if method == 'GET' and route == '/roles':
             return {'data': [
                 {
@@ -133,6 +174,8 @@ def test_apply_policies_preserves_builtin_and_assigned_policies():
     requests = []
 
     def fake_json(method, route, **kw):
+        if route.startswith('/fields'):
+            return {'data': []}
         if method == 'GET' and route == '/policies':
             return {'data': [
                 {
@@ -170,3 +213,624 @@ def test_export_extensions_includes_bundle_members():
     ]}
     result = api.export_extensions()
     assert {item['id'] for item in result} == {'top', 'bundle1', 'child'}
+
+
+def test_cached_reads_are_shared_until_the_route_is_mutated(monkeypatch):
+    calls = []
+    bodies = {'/settings': {'project_name': 'Old'}, '/roles': [{'id': 'r1'}]}
+
+    class FakeResponse:
+        ok = True
+        status_code = 200
+
+        def __init__(self, path):
+            self.content = json.dumps({'data': bodies.get(path, {})}).encode()
+
+        def raise_for_status(self):
+            pass
+
+        def json(self):
+            return json.loads(self.content)
+
+    def fake_request(session, method, url, **kw):
+        path = url.removeprefix('http://example.invalid')
+        calls.append((method, path))
+        return FakeResponse(path)
+
+    monkeypatch.setattr(requests.Session, 'request', fake_request)
+    api = API('http://example.invalid')
+    with api.cached():
+        api.export_roles()
+        api.apply_settings({'project_name': 'Old'})
+        api.export_settings()
+        api.export_roles()
+        api.json('POST', '/schema/diff')
+        api.export_roles()
+        api.json('PATCH', '/roles/r1', json={})
+        api.export_roles()
+        api.export_settings()
+    api.export_settings()
+    assert calls == [
+        ('GET', '/roles'), ('GET', '/settings'), ('POST', '/schema/diff'),
+        ('PATCH', '/roles/r1'), ('GET', '/roles'), ('GET', '/settings'),
+    ]
+
+
+def test_reads_during_a_mutation_are_not_kept(monkeypatch):
+    bodies = {'/roles': [{'id': 'r1', 'name': 'Old'}]}
+    api = API('http://example.invalid')
+
+    class FakeResponse:
+        ok = True
+        status_code = 200
+        def __init__(self, body):
+            self.content = json.dumps({'data': body}).encode()
+        def raise_for_status(self):
+            pass
+        def json(self):
+            return json.loads(self.content)
+
+    def fake_request(session, method, url, **kw):
+        path = url.removeprefix('http://example.invalid')
+        if method == 'PATCH':
+            # another branch reads the route before the server commits
+            assert api.export_roles()[0]['name'] == 'Old'
+            bodies['/roles'] = [{'id': 'r1', 'name': 'New'}]
+        return FakeResponse(bodies.get(path, {}))
+
+    monkeypatch.setattr(requests.Session, 'request', fake_request)
+    with api.cached():
+        api.json('PATCH', '/roles/r1', json={'name': 'New'})
+        assert api.export_roles()[0]['name'] == 'New'
+
+
+def test_apply_creates_each_dependency_layer_in_one_request():
+    api = API('http://example.invalid')
+    posts = []
+
+    def fake_json(method, route, **kw):
+        if method == 'GET':
+            return {'data': []}
+        posts.append(kw['json'])
+        return {'data': {}}
+
+    api.json = fake_json
+    api.apply_operations([
+        {'id': 'a', 'resolve': 'b', 'flow': 'f'},
+        {'id': 'b', 'resolve': 'c', 'flow': 'f'},
+        {'id': 'c', 'resolve': None, 'flow': 'f'},
+        {'id': 'd', 'resolve': None, 'flow': 'f'},
+    ], allow_delete=False)
+    assert [[d['id'] for d in p] if isinstance(p, list) else p['id'] for p in posts] == [
+        ['c', 'd'], 'b', 'a']
+
+
+def test_apply_bisects_rejected_create_batches():
+    from directus_git_sync.api import BatchError
+
+    api = API('http://example.invalid')
+    posts = []
+
+    def fake_json(method, route, **kw):
+        if method == 'GET':
+            return {'data': []}
+        batch = kw['json'] if isinstance(kw['json'], list) else [kw['json']]
+        ids = [d['id'] for d in batch]
+        posts.append(ids)
+        if 'bad' in ids:
+            response = requests.Response()
+            response.status_code = 400
+            raise requests.exceptions.HTTPError(response=response)
+        return {'data': {}}
+
+    api.json = fake_json
+    with pytest.raises(BatchError) as info:
+        api.apply_presets([{'id': i} for i in ['a', 'b', 'bad', 'c']], allow_delete=False)
+    # validation errors are fatal: isolated by bisection, never retried
+    assert posts == [['a', 'b', 'bad', 'c'], ['a', 'b'], ['bad', 'c'], ['bad'], ['c']]
+    assert set(info.value.errors) == {'bad'}
+
+
+def test_apply_retries_transient_create_failures_after_dependencies():
+    from directus_git_sync.api import BatchError
+
+    api = API('http://example.invalid')
+    api.retry_backoff = 0
+    posts = []
+    flaky = {'b': 1}
+
+    def fake_json(method, route, **kw):
+        if method == 'GET':
+            return {'data': []}
+        batch = kw['json'] if isinstance(kw['json'], list) else [kw['json']]
+        posts.append([d['id'] for d in batch])
+        for d in batch:
+            if d['id'] == 'bad' or flaky.get(d['id']):
+                flaky[d['id']] = 0
+                response = requests.Response()
+                response.status_code = 503 if d['id'] != 'bad' else 400
+                raise requests.exceptions.HTTPError(response=response)
+        return {'data': {}}
+
+    api.json = fake_json
+    with pytest.raises(BatchError) as info:
+        api.apply_operations([
+            {'id': 'a', 'resolve': None},
+            {'id': 'b', 'resolve': None},
+            {'id': 'bad', 'resolve': None},
+            {'id': 'c', 'resolve': 'b'},
+            {'id': 'd', 'resolve': 'bad'},
+        ], allow_delete=False)
+    # b is retried once the 503 passes, c waits for b, d is blocked by bad
+    assert posts == [['a', 'b', 'bad'], ['a', 'b', 'bad'], ['a'], ['b', 'bad'], ['b'], ['bad'], ['c']]
+    assert set(info.value.errors) == {'bad', 'd'}
+    assert 'blocked by bad' in str(info.value)
+
+
+def test_created_items_of_a_timed_out_request_unblock_their_dependents():
+    api = API('http://example.invalid')
+    api.retry_backoff = 0
+    committed, posts, gets = set(), [], []
+
+    def fake_json(method, route, **kw):
+        if method == 'GET':
+            params = kw.get('params') or {}
+            ids = json.loads(params['filter'])['id']['_in'] if route != '/fields' and 'filter' in params else []
+            gets.extend([route] if ids else [])
+            return {'data': [{'id': k} for k in ids if k in committed]}
+        batch = kw['json'] if isinstance(kw['json'], list) else [kw['json']]
+        posts.append([d['id'] for d in batch])
+        committed.update(d['id'] for d in batch)
+        if len(posts) == 1:  # committed, but the response never arrived
+            raise requests.exceptions.Timeout()
+        return {'data': {}}
+
+    api.json = fake_json
+    api.apply_operations([
+        {'id': 'a', 'resolve': None},
+        {'id': 'b', 'resolve': None},
+        {'id': 'c', 'resolve': 'a'},
+    ], allow_delete=False)
+    # the retry finds a and b with one read instead of posting them again
+    assert posts == [['a', 'b'], ['c']]
+    assert committed == {'a', 'b', 'c'} and len(gets) == 1
+
+
+def test_lookup_of_timed_out_creates_is_chunked_and_may_fail():
+    from directus_git_sync.api import BatchError
+
+    api = API('http://example.invalid')
+    api.retry_backoff = 0
+    api.batch_size = 1
+    committed, posts, gets = set(), [], []
+
+    def fake_json(method, route, **kw):
+        if method == 'GET':
+            params = kw.get('params') or {}
+            ids = json.loads(params['filter'])['id']['_in'] if route != '/fields' and 'filter' in params else []
+            gets.extend([ids] if ids else [])
+            return {'data': [{'id': k} for k in ids if k in committed]}
+        batch = kw['json'] if isinstance(kw['json'], list) else [kw['json']]
+        posts.append([d['id'] for d in batch])
+        committed.update(d['id'] for d in batch)
+        if len(posts) <= 2:
+            raise requests.exceptions.Timeout()
+        return {'data': {}}
+
+    api.json = fake_json
+    api.apply_operations([{'id': 'a'}, {'id': 'b'}], allow_delete=False)
+    assert posts == [['a'], ['b']] and gets == [['a'], ['b']]
+
+    # a failing lookup sends the items again, and still ends in a BatchError
+    def flaky_json(method, route, **kw):
+        if method == 'GET' and route != '/fields' and 'filter' in (kw.get('params') or {}):
+            raise requests.exceptions.ConnectionError('down')
+        if method == 'GET':
+            return {'data': []}
+        posts.append([kw['json']['id']])
+        raise requests.exceptions.Timeout()
+
+    posts.clear()
+    api.create_retries = 1
+    api.json = flaky_json
+    with pytest.raises(BatchError) as error:
+        api.apply_operations([{'id': 'x'}], allow_delete=False)
+    assert posts == [['x'], ['x']] and set(error.value.errors) == {'x'}
+
+
+def test_upsert_updates_existing_rows_and_raises_failed_creates():
+    from directus_git_sync.api import BatchError
+
+    api = API('http://example.invalid')
+    sent = []
+
+    def fake_json(method, route, params=None, json=None, **kw):
+        if method == 'GET':
+            return {'data': [{'pk': 1}], 'meta': {'filter_count': 1}}
+        sent.append((method, route, [d['pk'] for d in json] if isinstance(json, list) else json['pk']))
+        return {'data': {}}
+
+    api.json = fake_json
+    assert api.upsert_items('sensors', [{'pk': 1}, {'pk': 2}, {'pk': 3}], key='pk') == ([2, 3], [1])
+    assert sent == [('POST', '/items/sensors', [2, 3]), ('PATCH', '/items/sensors/1', 1)]
+
+    # a transient failure is not mistaken for an existing row
+    def unavailable(method, route, params=None, json=None, **kw):
+        if method == 'GET':
+            return {'data': [], 'meta': {'filter_count': 0}}
+        response = requests.Response()
+        response.status_code = 503
+        raise requests.exceptions.HTTPError(response=response)
+
+    api.json = unavailable
+    with pytest.raises(BatchError) as info:
+        api.upsert_items('sensors', [{'pk': 4}], key='pk')
+    assert set(info.value.errors) == {4}
+
+
+def test_apply_sends_updates_as_capped_bulk_patches_with_attribution():
+    from directus_git_sync.api import BatchError
+
+    api = API('http://example.invalid', batch_size=2)
+    patches = []
+
+    def fake_json(method, route, **kw):
+        if route.startswith('/fields'):
+            return {'data': []}
+        if method == 'GET':
+            return {'data': [{'id': i, 'action': 'read'} for i in range(1, 6)]}
+        patches.append((route, kw['json']))
+        body = kw['json'] if isinstance(kw['json'], list) else [kw['json']]
+        if any(d['id'] == 4 for d in body):
+            response = requests.Response()
+            response.status_code = 400
+            raise requests.exceptions.HTTPError(response=response)
+        return {'data': {}}
+
+    api.json = fake_json
+    with pytest.raises(BatchError) as info:
+        api.apply_permissions([{'id': i, 'action': 'update'} for i in range(1, 6)], allow_delete=False)
+
+    assert set(info.value.errors) == {4}
+    assert [route for route, _ in patches] == [
+        '/permissions', '/permissions', '/permissions/3', '/permissions/4', '/permissions/5']
+    assert [d['id'] for d in patches[0][1]] == [1, 2]
+
+
+def test_apply_sends_a_layer_concurrently_but_keeps_extensions_serial():
+    import threading
+
+    api = API('http://example.invalid', batch_size=1, concurrency=3)
+    barrier = threading.Barrier(3, timeout=5)
+
+    def fake_json(method, route, **kw):
+        if method == 'GET':
+            return {'data': []}
+        barrier.wait()
+        return {'data': {}}
+
+    api.json = fake_json
+    api.apply_presets([{'id': i} for i in range(3)], allow_delete=False)
+
+    threads = set()
+    api._map('/extensions', lambda x: threads.add(threading.get_ident()), range(5))
+    assert threads == {threading.get_ident()}
+
+
+def test_mutations_record_touched_routes_and_ids(monkeypatch):
+    class FakeResponse:
+        ok = True
+        status_code = 200
+
+        def __init__(self, method):
+            self.content = b'{"data": [{"id": "new-1"}, {"id": "new-2"}]}' if method == 'POST' else b''
+
+        def raise_for_status(self):
+            pass
+
+        def json(self):
+            return json.loads(self.content)
+
+    monkeypatch.setattr(requests.Session, 'request', lambda session, method, url, **kw: FakeResponse(method))
+    api = API('http://example.invalid')
+    api.json('POST', '/flows', json=[{'name': 'a'}, {'name': 'b'}])
+    api.json('PATCH', '/roles/r1', json={'name': 'x'})
+    api.json('DELETE', '/permissions', json=[3, 4])
+    api.json('GET', '/presets')
+    api.json('POST', '/schema/diff', json={})
+    assert api.touched == {'/flows': {'new-1', 'new-2'}, '/roles': {'r1'}, '/permissions': {'3', '4'}}
+
+
+def test_item_digest_ignores_key_order_and_ignored_keys():
+    a = {'id': 1, 'filter': {'a': 1, 'b': [1, {'x': 2, 'y': 3}]}, 'user_updated': 'u'}
+    b = {'filter': {'b': [1, {'y': 3, 'x': 2}], 'a': 1}, 'id': 1}
+    assert item_digest(a, {'user_updated'}) == item_digest(b)
+    assert item_digest(a) != item_digest(b)
+    assert item_digest({'id': 1, 'x': [1, 2]}) != item_digest({'id': 1, 'x': [2, 1]})
+
+
+def test_diff_items_reuses_stored_digests():
+    api = API('http://example.invalid')
+    desired = [{'id': 1, 'action': 'read'}, {'id': 2, 'action': 'read'}]
+    current = [{'id': 1, 'action': 'read'}, {'id': 2, 'action': 'update'}]
+    digests = {'1': item_digest(current[0]), '2': item_digest(current[1])}
+    assert api.diff_items('/permissions', desired, existing=current, digests=digests)['update'] == ['2']
+    # a stored digest stands in for hashing the current item again
+    digests['2'] = item_digest(desired[1])
+    assert api.diff_items('/permissions', desired, existing=current, digests=digests)['update'] == []
+
+
+def test_fetch_all_reads_every_page():
+    api = API('http://example.invalid')
+    api.page_size = 2
+    rows = [{'id': i} for i in range(5)]
+    requested = []
+
+    def fake_json(method, route, params=None, **kw):
+        requested.append(params['offset'])
+        page = rows[params['offset']:params['offset'] + params['limit']]
+        if params.get('meta') == 'filter_count':
+            return {'data': page, 'meta': {'filter_count': len(rows)}}
+        return {'data': page}
+
+    api.json = fake_json
+    assert api.export_permissions() == rows
+    assert sorted(requested) == [0, 2, 4]
+
+    # without a count, pages are read until a short one comes back
+    requested.clear()
+    api.json = lambda method, route, params=None, **kw: {
+        'data': rows[params['offset']:params['offset'] + params['limit']]}
+    assert api.export_presets() == rows
+
+    # a server that clamps limit is paged by what it returns
+    api.page_size = 500
+    requested.clear()
+
+    def clamped_json(method, route, params=None, **kw):
+        requested.append((params['offset'], params['sort']))
+        page = rows[params['offset']:params['offset'] + min(params['limit'], 2)]
+        return {'data': page, 'meta': {'filter_count': len(rows)}}
+    api.json = clamped_json
+    assert api.export_permissions() == rows
+    assert sorted(requested) == [(0, 'id'), (2, 'id'), (4, 'id')]
+
+
+def test_response_cache_revalidates_and_evicts(tmp_path, monkeypatch):
+    sent = []
+
+    def fake_request(session, method, url, headers=None, **kw):
+        sent.append(dict(headers))
+        response = requests.Response()
+        response.url = url
+        if headers.get('If-None-Match') == '"v1"':
+            response.status_code = 304
+            response._content = b''
+        else:
+            response.status_code = 200
+            response.headers['ETag'] = '"v1"'
+            response._content = json.dumps({'data': {'url': url}}).encode()
+        return response
+
+    monkeypatch.setattr(requests.Session, 'request', fake_request)
+    cache_dir = tmp_path / 'cache'
+    api = API('http://example.invalid', cache_dir=str(cache_dir), cache_size=10**6)
+    assert api.json('GET', '/settings') == {'data': {'url': 'http://example.invalid/settings'}}
+    assert api.json('GET', '/settings') == {'data': {'url': 'http://example.invalid/settings'}}
+    assert 'If-None-Match' not in sent[0] and sent[1]['If-None-Match'] == '"v1"'
+
+    # bodies may hold secrets, so only their owner can read them
+    import os
+    import stat
+    entry, = cache_dir.glob('*.gz')
+    assert stat.S_IMODE(os.stat(entry).st_mode) == 0o600
+    assert stat.S_IMODE(os.stat(cache_dir).st_mode) == 0o700
+
+    api.response_cache.max_bytes = 0
+    api.json('GET', '/roles')
+    assert list(cache_dir.glob('*.gz')) == []
+
+
+def test_schema_diff_is_skipped_while_both_sides_are_unchanged(tmp_path):
+    api = API('http://example.invalid', state_dir=str(tmp_path))
+    remote = {'version': 1, 'collections': [], 'fields': [], 'relations': []}
+    posts = []
+
+    def fake_json(method, route, **kw):
+        if route == '/schema/snapshot':
+            return {'data': remote}
+        posts.append(route)
+        return None  # Directus answers an empty diff with 204
+
+    api.json = fake_json
+    local = {'version': 1, 'collections': [], 'fields': [], 'relations': []}
+    assert api.diff_schema(dict(local)) is None
+    assert api.diff_schema(dict(local)) is None
+    assert posts == ['/schema/diff']
+
+    remote = {**remote, 'fields': [{'collection': 'x', 'field': 'y'}]}
+    api.diff_schema(dict(local))
+    api.apply_schema({})
+    api.diff_schema(dict(local))
+    api.diff_schema({**local, 'collections': [{'collection': 'x', 'meta': {}}]})
+    assert posts == ['/schema/diff'] * 2 + ['/schema/apply'] + ['/schema/diff'] * 2
+
+
+def test_registry_versions_resolve_concurrently_and_are_remembered(tmp_path):
+    import threading
+    barrier = threading.Barrier(2, timeout=5)
+    lookups = []
+
+    def fake_json(method, route, **kw):
+        lookups.append(route)
+        barrier.wait()  # both lookups must be in flight at once
+        return {'data': {'versions': [
+            {'id': f'{route[-1]}-old', 'version': '1.0.0'},
+            {'id': f'{route[-1]}-new', 'version': '2.0.0'},
+        ]}}
+
+    items = [
+        {'id': 'a', 'schema': {'name': 'a', 'version': '2.0.0'}},
+        {'id': 'b', 'schema': {'name': 'b', 'version': '1.0.0'}},
+    ]
+    api = API('http://example.invalid', state_dir=str(tmp_path))
+    api.json = fake_json
+    expected = {('a', '2.0.0'): 'a-new', ('b', '1.0.0'): 'b-old'}
+    assert api.registry_version_ids(items) == expected
+    assert len(lookups) == 2
+
+    again = API('http://example.invalid', state_dir=str(tmp_path))
+    again.json = lambda *a, **kw: pytest.fail('registry looked up again')
+    assert again.registry_version_ids(items) == expected
+
+
+def test_changed_files_since_the_applied_commit_become_a_scope(tmp_path):
+    import subprocess
+    from directus_git_sync.commands import SCOPE_TYPES
+    from directus_git_sync.revision import head_commit, changed_paths, changed_scope
+
+    def git(*args):
+        subprocess.run(['git', '-c', 'user.name=t', '-c', 'user.email=t@t', *args],
+                       cwd=tmp_path, check=True, capture_output=True)
+
+    (tmp_path / 'flows').mkdir()
+    (tmp_path / 'schema').mkdir()
+    (tmp_path / 'flows' / 'a.yaml').write_text('id: a\n')
+    (tmp_path / 'schema' / 'sensors.yaml').write_text('collection: sensors\n')
+    git('init', '-q')
+    git('add', '.')
+    git('commit', '-qm', 'init')
+    applied = head_commit(tmp_path)
+    assert head_commit(tmp_path.parent / 'missing') is None
+
+    (tmp_path / 'flows' / 'a.yaml').write_text('id: a\nname: A\n')
+    (tmp_path / 'schema' / 'deployments.yaml').write_text('collection: deployments\n')
+    (tmp_path / 'README.md').write_text('docs\n')
+    paths = changed_paths(tmp_path, applied)
+    assert paths == {'flows/a.yaml', 'schema/deployments.yaml', 'README.md'}
+    assert changed_scope(paths, SCOPE_TYPES) == ['deployments', 'flows']
+    assert changed_scope(paths | {'schema/__meta__.yaml'}, SCOPE_TYPES) == ['flows', 'schema']
+    assert changed_paths(tmp_path, '0' * 40) is None
+
+
+def test_activity_probe_maps_edited_system_collections_to_resource_types():
+    from directus_git_sync.commands import _activity_scope
+
+    api = API('http://example.invalid')
+    calls = []
+
+    def fake_json(method, path, **kw):
+        calls.append((method, path, kw['params']))
+        return {'data': [
+            {'collection': 'directus_flows', 'max': {'id': '41'}},
+            {'collection': 'directus_fields', 'max': {'id': 45}},
+        ]}
+    api.json = fake_json
+
+    assert _activity_scope(api, 40) == (['flows', 'schema'], 45)
+    method, path, params = calls[0]
+    assert (method, path, params['aggregate[max]'], params['groupBy[]']) == ('GET', '/activity', 'id', 'collection')
+    filters = json.loads(params['filter'])['_and']
+    assert {'id': {'_gt': 40}} in filters and 'directus_permissions' in filters[0]['collection']['_in']
+
+    # without a watermark only the next one is known
+    assert _activity_scope(api, None) == (None, 45)
+    api.json = lambda *a, **kw: {'data': []}
+    assert _activity_scope(api, 45) == ([], 45)
+
+
+def test_trigger_merges_a_burst_into_one_run():
+    import threading
+    import time
+    from directus_git_sync.serve import Trigger
+
+    trigger = Trigger(debounce=0.2)
+    assert trigger.wait(timeout=0.05) == set()
+
+    def burst():
+        for reason in ('files', 'files', 'signal'):
+            trigger.fire(reason)
+            time.sleep(0.05)
+    threading.Thread(target=burst).start()
+    started = time.monotonic()
+    assert trigger.wait(timeout=5) == {'files', 'signal'}
+    assert time.monotonic() - started >= 0.3  # waited for the burst to settle
+    assert trigger.wait(timeout=0.05) == set()
+
+
+def test_api_refreshes_the_access_token_before_it_expires(monkeypatch):
+    api = API('http://example.invalid')
+    posts = []
+
+    class Response:
+        def __init__(self, data):
+            self.data = data
+        def raise_for_status(self):
+            pass
+        def json(self):
+            return {'data': self.data}
+
+    def post(url, json=None, **kw):
+        posts.append((url.rsplit('/', 1)[-1], json))
+        return Response({'access_token': f'token-{len(posts)}', 'refresh_token': f'refresh-{len(posts)}', 'expires': 900000})
+    monkeypatch.setattr(api.session, 'post', post)
+    monkeypatch.setattr(api.session, 'request', lambda *a, headers=None, **kw: pytest.fail('unexpected'))
+
+    api.login('admin@example.com', 'password')
+    api._ensure_token()
+    assert [name for name, _ in posts] == ['login']
+
+    api.token_expires -= 890  # 10s left
+    api._ensure_token()
+    assert posts[-1] == ('refresh', {'refresh_token': 'refresh-1', 'mode': 'json'})
+    assert api.headers['Authorization'] == 'Bearer token-2' and api.refresh_token == 'refresh-2'
+
+
+def test_tokens_are_cached_privately_and_refreshed_before_logging_in_again(tmp_path, monkeypatch):
+    import os
+    import stat
+    posts = []
+
+    class Response:
+        def __init__(self, status, data=None):
+            self.status_code, self.data = status, data
+        def raise_for_status(self):
+            if self.status_code >= 400:
+                raise requests.exceptions.HTTPError(response=self)
+        def json(self):
+            return {'data': self.data}
+
+    refresh_ok = [True]
+
+    def post(url, json=None, **kw):
+        name = url.rsplit('/', 1)[-1]
+        posts.append(name)
+        if name == 'refresh' and not refresh_ok[0]:
+            return Response(401)
+        return Response(200, {'access_token': f'{name}-{len(posts)}', 'refresh_token': f'r{len(posts)}', 'expires': 900000})
+
+    def client():
+        api = API('http://example.invalid', token=None, token_dir=str(tmp_path))
+        monkeypatch.setattr(api.session, 'post', post)
+        return api.login('admin@example.com', 'password')
+
+    api = client()
+    assert posts == ['login']
+    token_file, = tmp_path.glob('token-*.json')
+    assert stat.S_IMODE(os.stat(token_file).st_mode) == 0o600
+
+    # a second run reuses the cached token without any request
+    assert client().headers['Authorization'] == api.headers['Authorization'] and posts == ['login']
+
+    # an expired cached token is refreshed, and the password is the last resort
+    cached = json.loads(token_file.read_text())
+    token_file.write_text(json.dumps({**cached, 'expires_at': 0}))
+    assert client().headers['Authorization'] == 'Bearer refresh-2' and posts == ['login', 'refresh']
+    refresh_ok[0] = False
+    token_file.write_text(json.dumps({**json.loads(token_file.read_text()), 'expires_at': 0}))
+    assert client().headers['Authorization'] == 'Bearer login-4' and posts[2:] == ['refresh', 'login']
+
+    # a static token needs no request at all
+    static = API('http://example.invalid', token='service-token', token_dir=str(tmp_path))
+    monkeypatch.setattr(static.session, 'post', lambda *a, **kw: pytest.fail('unexpected login'))
+    assert static.login().headers['Authorization'] == 'Bearer service-token'
@@ -0,0 +1,121 @@
+import copy
+import pytest
+import requests
+from ruamel.yaml import YAML
+import directus_git_sync as dg
+from directus_git_sync.api import API
+from directus_git_sync.schema_diff import deep_diff, diff_schema, diff_unpacked_schema, split_schema_diff
+yaml = YAML(typ='safe', pure=True)
+
+FNAME = 'tests/schema.yaml'
+
+
+def test_deep_diff_uses_the_directus_entry_format():
+    assert deep_diff(
+        {'meta': {'note': 'a', 'hidden': False}, 'options': ['x', 'y']},
+        {'meta': {'note': 'b', 'icon': 'box'}, 'options': ['x']},
+    ) == [
+        {'kind': 'E', 'path': ['meta', 'note'], 'lhs': 'a', 'rhs': 'b'},
+        {'kind': 'D', 'path': ['meta', 'hidden'], 'lhs': False},
+        {'kind': 'N', 'path': ['meta', 'icon'], 'rhs': 'box'},
+        {'kind': 'A', 'path': ['options'], 'index': 1, 'item': {'kind': 'D', 'lhs': 'y'}},
+    ]
+
+
+def test_schema_diff_matches_the_server_layout():
+    with open(FNAME) as file:
+        schema = dict(yaml.load(file))
+    unpacked = dg.util.unpack_schema(copy.deepcopy(schema))
+    assert diff_unpacked_schema(unpacked, unpacked) is None
+
+    desired = copy.deepcopy(schema)
+    field = desired['fields'][0]
+    field['meta'] = {**(field.get('meta') or {}), 'note': 'changed'}
+    relation = desired['relations'].pop()
+    desired['collections'].append({'collection': 'brand_new', 'meta': {}, 'schema': {}})
+
+    result = diff_schema(schema, desired)
+    assert [c['collection'] for c in result['diff']['collections']] == ['brand_new']
+    assert result['diff']['collections'][0]['diff'][0]['kind'] == 'N'
+    [changed] = result['diff']['fields']
+    assert (changed['collection'], changed['field']) == (field['collection'], field['field'])
+    assert changed['diff'] == [{'kind': 'E', 'path': ['meta', 'note'], 'lhs': None, 'rhs': 'changed'}]
+    [removed] = result['diff']['relations']
+    assert removed['related_collection'] == relation.get('related_collection')
+    assert removed['diff'] == [{'kind': 'D', 'lhs': relation}]
+
+
+def test_split_schema_diff_orders_dependencies():
+    new = lambda **item: {**item, 'diff': [{'kind': 'N', 'rhs': item}]}
+    gone = lambda **item: {**item, 'diff': [{'kind': 'D', 'lhs': item}]}
+    diff = {
+        'collections': [
+            new(collection='child', meta={'group': 'folder'}),
+            new(collection='folder', meta={}),
+            gone(collection='old'),
+        ],
+        'fields': [
+            new(collection='child', field='id'),
+            new(collection='existing', field='owner'),
+            gone(collection='existing', field='legacy'),
+            gone(collection='old', field='id'),
+        ],
+        'relations': [
+            new(collection='existing', field='owner', related_collection='child'),
+            gone(collection='existing', field='legacy', related_collection='old'),
+        ],
+    }
+    chunks = split_schema_diff(diff, 1)
+    names = [
+        [f"{key}:{e['collection']}.{e.get('field', '')}" for key in ('collections', 'fields', 'relations') for e in chunk[key]]
+        for chunk in chunks
+    ]
+    assert names == [
+        ['relations:existing.legacy'],
+        ['collections:folder.'],
+        ['collections:child.', 'fields:child.id'],
+        ['fields:existing.owner'],
+        ['relations:existing.owner'],
+        ['fields:existing.legacy'],
+        ['collections:old.', 'fields:old.id'],
+    ]
+    assert len(split_schema_diff(diff, 3)) == 3
+
+
+def test_chunked_apply_rediffs_for_each_hash_and_resumes(tmp_path):
+    pending = ['a', 'b', 'c']
+    applied = []
+
+    def fake_json(method, route, **kw):
+        if route == '/schema/snapshot':
+            return {'data': {'pending': list(pending)}}
+        if route == '/schema/diff':
+            if not pending:
+                return None
+            return {'data': {'hash': f'h{len(pending)}', 'diff': {
+                'collections': [{'collection': name, 'diff': [{'kind': 'N', 'rhs': {}}]} for name in pending],
+                'fields': [], 'relations': [],
+            }}}
+        assert kw['json']['hash'] == f'h{len(pending)}'
+        [collection] = kw['json']['diff']['collections']
+        applied.append(collection['collection'])
+        pending.remove(collection['collection'])
+        if len(applied) == 2:
+            raise requests.exceptions.ConnectionError('proxy timeout')
+        return {}
+
+    api = API('http://example.invalid', state_dir=str(tmp_path))
+    api.json = fake_json
+    schema = {'collections': [], 'fields': [], 'relations': []}
+    with pytest.raises(requests.exceptions.ConnectionError):
+        api.apply_schema_in_chunks(schema, chunk_size=1)
+    assert api.state.get('schema_chunks')['done'] == 1
+    api.apply_schema_in_chunks(schema, chunk_size=1)
+    assert applied == ['a', 'b', 'c'] and api.state.get('schema_chunks') is None
+
+
+def test_offline_schema_diff_command_keeps_the_module_importable():
+    import importlib
+    assert importlib.import_module('directus_git_sync.schema_diff').diff_schema is diff_schema
+    assert dg.schema_diff.split_schema_diff is split_schema_diff
+    assert callable(dg.diff_schema_dirs)